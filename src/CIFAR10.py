@@ -537,14 +537,25 @@ def batch_to_rgb(images: np.ndarray) -> np.ndarray:
 
 # -
 
+# Keep images in the default format for the feature store (see HOG model)
+train_raw, test_raw = train_data, test_data
+
 train_data = batch_to_rgb(train_data)
 test_data = batch_to_rgb(test_data)
 train_data.shape
 
 # As mentioned above, there are no missing values nor values out of range. Because the range of values for RGB is 0-255, we first transform values to floats and then scale to 0-1 interval.
 
-train_data = train_data / 255.0
-test_data = test_data / 255.0
+# +
+from precision import float_dtype
+
+
+# Floats in the project precision (float32 by default, see precision.py)
+train_data = train_data.astype(float_dtype())
+test_data = test_data.astype(float_dtype())
+train_data /= 255
+test_data /= 255
+# -
 
 # Now, each image has 32 * 32 * 3 = 3,072 features. However, from the correlation matrix we saw, that there are many correlated features, so we will apply two different procedures:
 #
@@ -625,21 +636,13 @@ ax[1].set_title("Grayscaled");
 
 # +
 from skimage.feature import hog
-from joblib import Parallel, delayed
+import feature_store
 
 
-# Converts to hog one picture
-def to_hog(picture):
-    return hog(picture, cells_per_block=(2, 2), pixels_per_cell=(8, 8))
-
-
-# Convert to hog
-hog_train = np.asarray(
-    Parallel(n_jobs=-1, batch_size=1000)(delayed(to_hog)(x) for x in hog_train)
-)
-hog_test = np.asarray(
-    Parallel(n_jobs=-1, batch_size=1000)(delayed(to_hog)(x) for x in hog_test)
-)
+# Convert to hog (computed once and stored on disk, shared with KNN.py and
+# baseline.py, see feature_store.py), same as hog() for each grayscaled picture
+hog_train = feature_store.load_features('gray_hog', train_raw, 'train')
+hog_test = feature_store.load_features('gray_hog', test_raw, 'test')
 # -
 
 # Again, we will show the difference between the transformed picture and the original:
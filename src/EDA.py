@@ -12,7 +12,6 @@ import utils
 import graphs
 import seaborn as sns
 import pandas as pd
-from typing import Dict
 
 
 def plot_category_dist(labels, label_names):
@@ -30,13 +29,13 @@ def plot_category_dist(labels, label_names):
     return sns.barplot(x="Category", y="Pictures", data=frame)
 
 
-def plot_avg_imgs(batch: Dict, with_histogram: bool = True,
+def plot_avg_imgs(dataset: utils.CifarDataset, with_histogram: bool = True,
                   with_hsv: bool = False) -> np.array:
     """
     Plot average image and optionally also histogram of RGB values for each
     category.
 
-    :param batch: dictionary with images and labels
+    :param dataset: dataset with images and labels
     :param with_histogram: whether to plot also histograms
     :param with_hsv: transform avg image to hsv and plot histogram
     :return: np.array of average images (in raw ravel form)
@@ -56,7 +55,7 @@ def plot_avg_imgs(batch: Dict, with_histogram: bool = True,
     avg_imgs = []
     
     for i in range(10):
-        imgs = utils.imgs_of_cat(batch, i)
+        imgs = dataset.imgs_of_cat(i)
         avg_img = np.mean(imgs, axis=0)
         avg_imgs.append(avg_img)
         x, y = i % 5, i // 5
@@ -80,23 +79,23 @@ def plot_avg_imgs(batch: Dict, with_histogram: bool = True,
     return np.array(avg_imgs)
 
 
-def plot_global_hist(batch: Dict, sample_size: int = 50) -> None:
+def plot_global_hist(dataset: utils.CifarDataset, sample_size: int = 50) -> None:
     """
     Histogram of RGB values from whole batch. Take all values into account
     instead of making an average image. But because whole dataset is too large,
     we use only random subsample of default size 50 images from each category.
 
-    :param batch: dictionary with images and labels
+    :param dataset: dataset with images and labels
     :param sample_size: size of random sample of each category
     """
     fig, axs = plt.subplots(2, 5, figsize=(15, 8))
 
     for i in range(10):
-        imgs = utils.imgs_of_cat(batch, i)
+        imgs = dataset.imgs_of_cat(i)
         imgs = imgs[np.random.choice(imgs.shape[0], sample_size)]
         x, y = i % 5, i // 5
 
-        axs[y][x].set_title(utils.get_label_name(i))
+        axs[y][x].set_title(dataset.label_name(i))
         graphs.plot_rgb_hist(imgs, axs[y][x])
 
 
@@ -156,17 +155,16 @@ def detect_outliers(imgs: np.ndarray, labels: np.ndarray, test_size: int) -> Non
 
 
 if __name__ == '__main__':
-    batch = utils.load_data_batch(1)
+    dataset = utils.CifarDataset.from_batch(utils.load_data_batch(1))
 
     # Print dataset size info about each category
     for i in range(10):
-        imgs = utils.imgs_of_cat(batch, i)
-        print(f"Category {i}: {utils.get_label_name(i)}")
-        print(f"Size: {imgs.shape[0]}")
+        print(f"Category {i}: {dataset.label_name(i)}")
+        print(f"Size: {dataset.counts[i]}")
         print()
 
     # Find average image and plot histogram of RGB values for each category.
-    avg_imgs = plot_avg_imgs(batch)
+    avg_imgs = plot_avg_imgs(dataset)
     plt.tight_layout()
     plt.show()
 
@@ -178,11 +176,11 @@ if __name__ == '__main__':
     plt.figure(figsize=(10, 5))
     plt.title('Hierarchical Clustering Dendrogram')
     plot_dendrogram(model, truncate_mode=None,
-            labels=[utils.get_label_name(i) for i in range(10)])
+            labels=dataset.label_names)
     plt.xlabel("Category")
     plt.show()
 
     # Lets look at global histogram of each category. Use default size 50.
-    plot_global_hist(batch)
+    plot_global_hist(dataset)
     plt.tight_layout()
     plt.show()
@@ -2,26 +2,20 @@ from sklearn.neighbors import KNeighborsClassifier
 from sklearn.model_selection import\
     GridSearchCV, cross_val_score, train_test_split
 from sklearn.utils import resample
-from sklearn.decomposition import PCA
 from sklearn.utils import resample
 
-from skimage.color import rgb2gray, rgb2hsv
-from skimage.feature import hog
-
 from matplotlib import pyplot as plt
 import seaborn as sns
 
 import numpy as np
 
-from preprocessing import batch_to_rgb
 from cache import cache
+from transformers import CenteredPCA
+import feature_store
 import utils
 
-@cache
-def gray_hog_prep(sample_X):
-    gray_X = rgb2gray(batch_to_rgb(sample_X))
-    hog_X = np.array(list(map(
-        lambda img: hog(img, cells_per_block=(2, 2)), gray_X)))
+def gray_hog_prep(sample_X, split='train'):
+    hog_X = feature_store.load_features('gray_hog', sample_X, split)
     return hog_X
 #KNeighborsClassifier(algorithm='auto', leaf_size=30, metric='minkowski',
 #                     metric_params=None, n_jobs=None, n_neighbors=10, p=1,
@@ -30,11 +24,8 @@ def gray_hog_prep(sample_X):
 
 gray_hog_model = KNeighborsClassifier(algorithm='auto', leaf_size=30, metric='minkowski', metric_params=None, n_jobs=None, n_neighbors=10, p=1, weights='distance')
 
-@cache
-def rgb_hog_prep(sample_X):
-    rgb_X = batch_to_rgb(sample_X)
-    hog_X = np.array(list(map(lambda img:
-        hog(img, cells_per_block=(2, 2), multichannel=True), rgb_X)))
+def rgb_hog_prep(sample_X, split='train'):
+    hog_X = feature_store.load_features('rgb_hog', sample_X, split)
     return hog_X
 #KNeighborsClassifier(algorithm='auto', leaf_size=30, metric='minkowski',
 #                     metric_params=None, n_jobs=None, n_neighbors=12, p=1,
@@ -43,17 +34,9 @@ def rgb_hog_prep(sample_X):
 
 rgb_hog_model = KNeighborsClassifier(algorithm='auto', leaf_size=30, metric='minkowski', metric_params=None, n_jobs=None, n_neighbors=12, p=1, weights='distance')
 
-@cache
-def hue_pca_prep(sample_X):
-    hue_X = rgb2hsv(batch_to_rgb(sample_X) / 255.)[:, :, :, 0]
-    hue_X = hue_X.reshape((sample_X.shape[0], -1))
-    centered_X = hue_X - np.mean(hue_X, axis=0)
-    pca = PCA(
-        n_components=0.95,  # keep at least 95% of variance
-        svd_solver='full',  # given by previous
-        copy=True,          # apply the same transform to test set as well
-    ).fit(centered_X)
-    return pca.transform(centered_X)
+def hue_pca_prep(sample_X, split='train'):
+    hue_X = feature_store.load_features('hue', sample_X, split)
+    return CenteredPCA(variance=0.95).fit_transform(hue_X)
 #KNeighborsClassifier(algorithm='auto', leaf_size=30, metric='minkowski',
 #                     metric_params=None, n_jobs=None, n_neighbors=7, p=3,
 #                     weights='distance')
@@ -61,7 +44,7 @@ def hue_pca_prep(sample_X):
 
 hue_pca_model = KNeighborsClassifier(algorithm='auto', leaf_size=30, metric='minkowski', metric_params=None, n_jobs=None, n_neighbors=7, p=3, weights='distance')
 
-@cache
+@cache(codec='auto')
 def grid_search(train_X, train_y):
     param_grid = {
         'n_neighbors': [3, 5, 7, 10, 12],
@@ -110,3 +110,19 @@ def tree_classifier(train_x, train_y, valid_x, valid_y, grid=False):
     predictions = dtree.predict(valid_x)
     accuracy = accuracy_score(valid_y, predictions)
     return dtree, predictions, accuracy
+
+
+if __name__ == '__main__':
+    import feature_store
+    import utils
+
+    train_x, train_y = utils.read_dataset()
+    test_x, test_y = utils.read_test_batch()
+
+    # HOG features shared with KNN.py and the notebook (see feature_store)
+    for name in ('gray_hog', 'rgb_hog'):
+        train_X = feature_store.load_features(name, train_x, 'train')
+        test_X = feature_store.load_features(name, test_x, 'test')
+        for classifier in (dummy_classifier, tree_classifier):
+            _, _, accuracy = classifier(train_X, train_y, test_X, test_y)
+            print(f"{name} {classifier.__name__}: {accuracy}")
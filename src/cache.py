@@ -1,52 +1,502 @@
 import pickle
 import os
-from typing import Callable, Dict, Tuple, Any
+import threading
+import weakref
+from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+from typing import Callable, ContextManager, Dict, Tuple, Any
+
+
+def _digest():
+    """
+    :return: fresh streaming digest, xxhash if installed, else blake2b
+    """
+    try:
+        import xxhash
+        return xxhash.xxh3_128()
+    except ImportError:
+        from hashlib import blake2b
+        return blake2b(digest_size=16)
+
+
+def _update_array(m, arr) -> None:
+    """
+    Feeds the digest with dtype, shape and raw buffer of numpy array.
+    Non-contiguous arrays are fed by chunks of rows to avoid a full copy.
+
+    :param m: digest to update
+    :param arr: np.ndarray to be hashed
+    """
+    import numpy as np
+
+    m.update(f"{arr.dtype.str}{arr.shape}".encode('utf-8'))
+    if arr.dtype.hasobject:
+        # No raw buffer to hash, go through the elements
+        _update(m, arr.tolist())
+    elif arr.flags.c_contiguous:
+        m.update(arr.reshape(-1).view(np.uint8))
+    else:
+        rows = max(1, (1 << 24) // max(1, arr[:1].nbytes))
+        for i in range(0, arr.shape[0], rows):
+            m.update(np.ascontiguousarray(arr[i:i + rows]).reshape(-1).view(np.uint8))
+
+
+def _update(m, obj: Any, seen: frozenset = frozenset()) -> None:
+    """
+    Feeds the digest with deterministic structural representation of obj:
+    containers are traversed recursively (dicts and sets independently
+    of their order), arrays are hashed by content, functions by their name
+    (and code fingerprint, see _fingerprint) and other objects
+    by their attributes or, as a last resort, by their string representation.
+
+    :param m: digest to update
+    :param obj: object to be hashed
+    :param seen: ids of objects on the current path (to stop on cycles)
+    """
+    import inspect
+    import numpy as np
+
+    m.update(type(obj).__qualname__.encode('utf-8') + b':')
+    if obj is None or isinstance(obj, (bool, int, float, complex, np.generic)):
+        m.update(repr(obj).encode('utf-8'))
+    elif isinstance(obj, str):
+        m.update(obj.encode('utf-8'))
+    elif isinstance(obj, (bytes, bytearray)):
+        m.update(obj)
+    elif id(obj) in seen:
+        m.update(b'<cycle>')
+    elif isinstance(obj, np.ndarray):
+        _update_array(m, obj)
+    elif isinstance(obj, (list, tuple)):
+        m.update(str(len(obj)).encode('utf-8'))
+        for item in obj:
+            _update(m, item, seen | {id(obj)})
+    elif isinstance(obj, dict):
+        items = sorted((_hash(k), _hash(v)) for k, v in obj.items())
+        m.update(repr(items).encode('utf-8'))
+    elif isinstance(obj, (set, frozenset)):
+        m.update(repr(sorted(_hash(item) for item in obj)).encode('utf-8'))
+    elif inspect.isfunction(obj):
+        # Functions by name, project functions also by their code
+        m.update(_qualified_name(obj).encode('utf-8'))
+        if _is_project_code(obj):
+            m.update(_fingerprint(obj).encode('utf-8'))
+    elif hasattr(obj, '__dict__') and not callable(obj):
+        _update(m, vars(obj), seen | {id(obj)})
+    else:
+        m.update(str(obj).encode('utf-8'))
+
+
+# Number of bytes sampled (from start, middle and end) of files whose
+# path is an argument of cached function, 0 to use only size and mtime
+FILE_SAMPLE_BYTES = 0
+
+
+def _file_fingerprint(path: str) -> str:
+    """
+    Cheap fingerprint of file, or of directory (its direct content): name,
+    size and modification time of the files, and optionally a hash of
+    FILE_SAMPLE_BYTES sampled from each file.
+
+    :param path: path of existing file or directory
+    :return: fingerprint in hex representation
+    """
+    m = _digest()
+    if os.path.isdir(path):
+        files = sorted(entry.path for entry in os.scandir(path) if entry.is_file())
+    else:
+        files = [path]
+    for file_path in files:
+        stat = os.stat(file_path)
+        m.update(f"{os.path.basename(file_path)}:{stat.st_size}:"
+                 f"{stat.st_mtime_ns};".encode('utf-8'))
+        if FILE_SAMPLE_BYTES > 0:
+            with open(file_path, 'rb') as f:
+                for offset in (0, stat.st_size // 2,
+                               stat.st_size - FILE_SAMPLE_BYTES):
+                    f.seek(max(0, offset))
+                    m.update(f.read(FILE_SAMPLE_BYTES))
+    return m.hexdigest()
+
+
+# Arrays with known source, id -> (weak reference, token), see tag_source
+_SOURCES = {}
+
+
+def tag_source(arr: Any, path: str, label: str = "") -> None:
+    """
+    Marks read-only array as loaded from file, so that cache keys use
+    the path and fingerprint of the file (see _file_fingerprint) instead
+    of hashing the whole content of the array. Writable arrays are ignored,
+    as their content may change.
+
+    :param arr: read-only np.ndarray
+    :param path: path of the file the array was loaded from
+    :param label: distinguishes more arrays loaded from the same file
+    """
+    if arr.flags.writeable:
+        return
+    token = f"{os.path.abspath(path)}:{_file_fingerprint(path)}:{label}"
+    key = id(arr)
+    _SOURCES[key] = (weakref.ref(arr, lambda _: _SOURCES.pop(key, None)), token)
 
 
 def _hash(obj: Any) -> str:
     """
     Computes hash of obj. For ints,
     it does not compute hash, rather it
-    returns their value. For non-hashable types,
-    returns hash of their string representation
-    and append 'S' to indicate this
+    returns their value. Numpy arrays are hashed
+    by their raw content, dtype and shape (suffix 'N')
+    or by their source (suffix 'T', see tag_source),
+    paths of existing files by the path and file fingerprint
+    (suffix 'P', see _file_fingerprint),
+    other objects by their structure (suffix 'S').
 
     :param obj: object to be hashed
     :return: hash in hex representation
     """
-    from hashlib import md5
+    import numpy as np
 
     if isinstance(obj, int):
         return str(obj)
-    m = md5()
-    m.update(str(obj).encode('utf-8'))
+    m = _digest()
+    if isinstance(obj, np.ndarray):
+        ref, token = _SOURCES.get(id(obj), (None, None))
+        if ref is not None and ref() is obj:
+            m.update(f"{obj.dtype.str}{obj.shape}{token}".encode('utf-8'))
+            return m.hexdigest() + "T"
+        _update_array(m, obj)
+        return m.hexdigest() + "N"
+    _update(m, obj)
+    if isinstance(obj, str) and obj and os.path.exists(obj):
+        m.update(_file_fingerprint(obj).encode('utf-8'))
+        return m.hexdigest() + "P"
     return m.hexdigest() + "S"
 
 
-def _create_name(func: Callable, args: Tuple, kwargs: Dict) -> str:
+def content_hash(obj: Any) -> str:
+    """
+    Hash of obj as in names of cache entries (see _hash), e.g. arrays
+    by their content or source file, project functions by their code.
+    Usable as fingerprint of data or code outside of the cache.
+
+    :param obj: object to be hashed
+    :return: hash in hex representation (with suffix of its kind)
+    """
+    return _hash(obj)
+
+
+# Functions returning global settings the cached results depend on
+# besides arguments and code (e.g. precision), see add_key_context
+_KEY_CONTEXTS = []
+# Key context -> function restoring its value in background thread
+_KEY_CONTEXT_APPLY = {}
+
+
+def add_key_context(context: Callable[[], Any],
+                    apply: Callable[[Any], ContextManager] = None) -> None:
+    """
+    Registers function returning global setting, which results of cached
+    functions depend on (e.g. floating point precision). Its current
+    value (unless None) becomes part of names of all entries.
+
+    Background computations (see prefetch) capture the value when they
+    are submitted, apply(value) then sets it in the worker thread while
+    the computation runs, so the result matches the name of its entry.
+
+    :param context: function without arguments
+    :param apply: function returning context manager, which sets given
+                  value of the setting in the current thread only
+    """
+    if context not in _KEY_CONTEXTS:
+        _KEY_CONTEXTS.append(context)
+    if apply is not None:
+        _KEY_CONTEXT_APPLY[context] = apply
+
+
+def _key_context() -> list:
+    """
+    :return: (name, value) of registered key contexts with value
+    """
+    values = [(f"{context.__module__}.{context.__qualname__}", context())
+              for context in _KEY_CONTEXTS]
+    return [item for item in values if item[1] is not None]
+
+
+# Longer names of entries are shortened by hashing their arguments part
+# (file names are limited to 255 bytes, including suffixes of locks)
+MAX_NAME_LENGTH = 200
+
+
+def _create_name(func: Callable, args: Tuple, kwargs: Dict,
+                 version: str = None) -> str:
     """
     Creates name of file to store cache based on
-    function name, args and kwargs.
+    function name, args and kwargs. Default values of parameters
+    that are paths of existing files are included as well (see _hash),
+    and so are the values of key contexts (see add_key_context).
+    Names longer than MAX_NAME_LENGTH have the arguments part hashed.
 
     :param func: Called function
     :param args: its arguments
     :param kwargs: key-word arguments
+    :param version: fingerprint of the function code (see _fingerprint)
     :return: str with filename
     """
-    name = f"F={func.__name__}__ARGS="
+    name = f"F={func.__name__}__"
+    if version is not None:
+        name += f"V={version}__"
+    context = _key_context()
+    if context:
+        name += f"C={_hash(context)[:12]}__"
+    name += "ARGS="
     for arg in args:
         name += f"{_hash(arg)}_"
     name += "_KWARGS="
     for key in sorted(kwargs.keys()):
         val = kwargs[key]
         name += f"{key}-{_hash(val)}_"
+    defaults = _path_defaults(func, len(args), kwargs)
+    if defaults:
+        name += "_DEFAULTS="
+        for key, val in defaults:
+            name += f"{key}-{_hash(val)}_"
     name += ".cache"
+    if len(name) > MAX_NAME_LENGTH:
+        # Too long for file systems, keep readable function and version
+        m = _digest()
+        m.update(name.encode('utf-8'))
+        name = f"{name[:name.index('ARGS=')]}H={m.hexdigest()}.cache"
     return name
 
 
+def _path_defaults(func: Callable, n_args: int, kwargs: Dict) -> list:
+    """
+    :param func: Called function
+    :param n_args: number of passed positional arguments
+    :param kwargs: passed key-word arguments
+    :return: (name, value) of not passed parameters with default value
+             being path of existing file or directory
+    """
+    import inspect
+
+    try:
+        params = list(inspect.signature(func).parameters.values())
+    except (TypeError, ValueError):
+        return []
+    return [
+        (param.name, param.default) for param in params[n_args:]
+        if param.name not in kwargs and isinstance(param.default, str)
+        and param.default and os.path.exists(param.default)
+    ]
+
+
+# Directory with the project sources, code of functions defined here
+# is part of the fingerprint of cached functions
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _is_project_code(obj: Any) -> bool:
+    """
+    :param obj: any object
+    :return: whether obj is function, class or module defined in PROJECT_DIR
+    """
+    import inspect
+
+    if not (inspect.isfunction(obj) or inspect.isclass(obj)
+            or inspect.ismodule(obj)):
+        return False
+    module = obj if inspect.ismodule(obj) else inspect.getmodule(obj)
+    filename = getattr(module, '__file__', None)
+    return filename is not None and \
+        os.path.dirname(os.path.abspath(filename)) == PROJECT_DIR
+
+
+def _code_names(code) -> set:
+    """
+    :param code: code object
+    :return: global and attribute names used by code (and nested code)
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            names |= _code_names(const)
+    return names
+
+
+def _imported_modules(code) -> list:
+    """
+    :param code: code object
+    :return: project modules imported inside code (and nested code),
+             e.g. by local "from transformers import HogTransformer"
+    """
+    import dis
+    import importlib
+    import importlib.util
+    import sys
+
+    modules = []
+    for instruction in dis.get_instructions(code):
+        if instruction.opname != 'IMPORT_NAME':
+            continue
+        name = instruction.argval
+        module = sys.modules.get(name)
+        if module is None:
+            # Not imported yet (the import runs only when code does)
+            try:
+                spec = importlib.util.find_spec(name)
+            except (ImportError, ValueError):
+                continue
+            origin = getattr(spec, 'origin', None)
+            if origin is None or os.path.dirname(os.path.abspath(origin)) != PROJECT_DIR:
+                continue
+            module = importlib.import_module(name)
+        if _is_project_code(module):
+            modules.append(module)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            modules.extend(_imported_modules(const))
+    return modules
+
+
+def _module_name(obj: Any) -> str:
+    """
+    :param obj: function or class
+    :return: name of its module, for code of script run as __main__
+             the name under which the script is imported (e.g. KNN)
+    """
+    import sys
+
+    module = getattr(obj, '__module__', None) or ''
+    if module == '__main__':
+        path = getattr(sys.modules.get('__main__'), '__file__', None)
+        if path is not None:
+            return os.path.splitext(os.path.basename(path))[0]
+    return module
+
+
+def _qualified_name(obj: Any) -> str:
+    """
+    :param obj: function or class
+    :return: module and qualified name of obj (see _module_name)
+    """
+    return f"{_module_name(obj)}.{getattr(obj, '__qualname__', '')}"
+
+
+def _project_refs(value: Any) -> list:
+    """
+    :param value: object referenced by code
+    :return: project functions and classes it stands for: value itself,
+             items of a container (e.g. dict of functions), or class
+             of an instance
+    """
+    import inspect
+
+    if inspect.isfunction(value) or inspect.isclass(value):
+        values = [value]
+    elif isinstance(value, dict):
+        values = list(value.values())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        values = list(value)
+    elif value is not None and _is_project_code(type(value)):
+        values = [type(value)]
+    else:
+        values = []
+    return [inspect.unwrap(item) for item in values
+            if not inspect.ismodule(item) and _is_project_code(item)]
+
+
+def _class_code(cls: type) -> list:
+    """
+    :param cls: project class
+    :return: its methods (also static, class methods and properties)
+             and its project base classes
+    """
+    import inspect
+
+    code = [base for base in cls.__mro__[1:] if _is_project_code(base)]
+    for member in vars(cls).values():
+        if isinstance(member, (staticmethod, classmethod)):
+            member = member.__func__
+        if isinstance(member, property):
+            code.extend(inspect.unwrap(f) for f in (member.fget, member.fset, member.fdel)
+                        if _is_project_code(f))
+        elif _is_project_code(member) and inspect.isfunction(member):
+            code.append(inspect.unwrap(member))
+    return code
+
+
+def _fingerprint(func: Callable) -> str:
+    """
+    Fingerprint of the code of func and of the project functions and
+    classes it uses (transitively), i.e. functions and classes defined
+    in PROJECT_DIR and referenced by name, as attribute of project
+    module (e.g. utils.read_dataset), imported inside the function
+    (e.g. from transformers import HogTransformer), through module-level
+    containers (e.g. dict of functions) or instances. Classes contribute their
+    source and the code used by their methods and project base classes.
+    Changing any of them changes the fingerprint. The fingerprint is the
+    same whether the code runs as script (__main__) or is imported.
+
+    Known limits: values of constants (e.g. CHUNK_SIZE) are not part
+    of the fingerprint, and neither is code reached only dynamically,
+    e.g. methods of objects passed as arguments or looked up by getattr.
+
+    :param func: function to fingerprint
+    :return: short hex digest
+    """
+    import inspect
+
+    m = _digest()
+    seen = set()
+    stack = [inspect.unwrap(func)]
+    while stack:
+        obj = stack.pop()
+        key = _qualified_name(obj)
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            source = repr(getattr(getattr(obj, '__code__', None), 'co_code', obj))
+        if (key, source) in seen:
+            continue
+        seen.add((key, source))
+        m.update(f"{key}:{source}".encode('utf-8'))
+
+        if inspect.isclass(obj):
+            stack.extend(reversed(_class_code(obj)))
+            continue
+        code = getattr(obj, '__code__', None)
+        if code is None:
+            continue
+        names = _code_names(code)
+        modules = _imported_modules(code)
+        for name in sorted(names):
+            used = obj.__globals__.get(name)
+            if inspect.ismodule(used):
+                if _is_project_code(used):
+                    modules.append(used)
+            else:
+                stack.extend(_project_refs(used))
+        # Names used as attributes of project modules or imported from them
+        for module in modules:
+            for attr in sorted(names):
+                stack.extend(_project_refs(getattr(module, attr, None)))
+    return m.hexdigest()[:12]
+
+
 # Path to directory with cached results
 CACHE_DIR = "../cache"
 
+# Maximal total size of cached entries in bytes (None for no limit)
+CACHE_MAX_BYTES = None
+
+# Which entries to evict first: 'lru' (least recently used) or 'cost',
+# which also keeps longer the entries that are expensive to recompute
+CACHE_POLICY = "lru"
+
+# Name of the file with size, last access and compute cost of entries
+INDEX_NAME = "index.json"
+
 
 def cache_init() -> None:
     """
@@ -60,7 +510,8 @@ def cache_init() -> None:
 
 def clear_cache() -> None:
     """
-    Clear the content of cache directory
+    Clear the content of cache directory, and the memory tiers
+    of all cached functions
 
     See: https://stackoverflow.com/a/185941
     :return: None
@@ -68,6 +519,9 @@ def clear_cache() -> None:
     import shutil
     for file_name in os.listdir(CACHE_DIR):
         file_path = os.path.join(CACHE_DIR, file_name)
+        if file_name in (LOCKS_DIR, INDEX_NAME + ".lock"):
+            # Locks may be held by others, removed below only if unused
+            continue
         try:
             if os.path.isfile(file_path) or os.path.islink(file_path):
                 os.unlink(file_path)
@@ -75,9 +529,1385 @@ def clear_cache() -> None:
                 shutil.rmtree(file_path)
         except OSError as e:
             print('Failed to delete %s. Reason: %s' % (file_path, e))
+    _remove_stale_locks()
+    for memory in list(_MEMORY_CACHES):
+        memory.clear()
+
+
+class _FileLock:
+    """
+    Exclusive lock shared by processes (and threads) through a lock file.
+    The lock is held by the OS, hence it is released even if the holding
+    process dies. Used as context manager. Unused lock files may be removed
+    (see _remove_lock), the lock is then taken on a new file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def __enter__(self) -> '_FileLock':
+        self._file = open(self.path, 'a+b')
+        if os.name == 'nt':
+            import msvcrt
+            while True:
+                try:
+                    # Retries for 10 seconds, then raises
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        else:
+            import fcntl
+            while True:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+                if _is_same_file(self._file, self.path):
+                    break
+                # The file was removed while waiting for it, lock the new one
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+                self._file.close()
+                self._file = open(self.path, 'a+b')
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if os.name == 'nt':
+            import msvcrt
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+
+
+def _is_same_file(file, path: str) -> bool:
+    """
+    :param file: open file
+    :param path: path of file
+    :return: whether path (still) refers to the open file
+    """
+    try:
+        return os.path.samestat(os.fstat(file.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+def _remove_lock(path: str) -> None:
+    """
+    Removes lock file of _FileLock, unless the lock is held (or waited
+    for) by someone. Lock files are kept on Windows.
+
+    :param path: path of the lock file
+    """
+    if os.name == 'nt':
+        return
+    import fcntl
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # In use
+            return
+        if _is_same_file(f, path):
+            os.unlink(path)
+
+
+def _is_entry(file_name: str) -> bool:
+    """
+    :param file_name: name of file in CACHE_DIR
+    :return: whether it is a cache entry (not index, lock, ...)
+    """
+    return file_name.endswith(".cache")
+
+
+def _entry_size(entry_path: str) -> int:
+    """
+    :param entry_path: path of cache entry (file or directory)
+    :return: size of the entry on disk in bytes
+    """
+    if os.path.isfile(entry_path):
+        return os.path.getsize(entry_path)
+    return sum(
+        os.path.getsize(os.path.join(entry_path, file_name))
+        for file_name in os.listdir(entry_path)
+    )
+
+
+def _read_index() -> Dict[str, Dict]:
+    """
+    :return: content of the index, i.e. name of entry -> its record
+    """
+    import json
+    try:
+        with open(os.path.join(CACHE_DIR, INDEX_NAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_index(index: Dict[str, Dict]) -> None:
+    """
+    Atomically replaces the index, must be called with the index lock held.
+
+    :param index: name of entry -> its record
+    """
+    import json
+    index_path = os.path.join(CACHE_DIR, INDEX_NAME)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+
+def _index_lock() -> _FileLock:
+    """
+    :return: lock guarding the index
+    """
+    return _FileLock(os.path.join(CACHE_DIR, INDEX_NAME + ".lock"))
+
+
+def _touch_entry(name: str, **record) -> None:
+    """
+    Updates record of the entry in the index, sets its last access to now.
+    Entries missing in the index are added with their size on disk.
+
+    :param name: name of the entry
+    :param record: fields to be set (size, cost, function, fingerprint)
+    """
+    from time import time
+    with _index_lock():
+        index = _read_index()
+        entry = index.get(name)
+        if entry is None:
+            entry = index[name] = {'cost': 0.0}
+            if 'size' not in record:
+                try:
+                    entry['size'] = _entry_size(os.path.join(CACHE_DIR, name))
+                except OSError:
+                    # Removed in the meantime, evict() will drop the record
+                    entry['size'] = 0
+        entry.update(record, last_access=time())
+        _write_index(index)
+
+
+def _remove_entry(entry_path: str) -> None:
+    """
+    Removes entry so that processes currently reading it are not affected:
+    the entry is first atomically renamed out of the way (so it is not
+    found anymore) and only then deleted. Files that are already open or
+    memory-mapped stay readable until closed (on POSIX systems).
+
+    :param entry_path: path of the entry
+    """
+    import shutil
+    import uuid
+    trash_path = os.path.join(CACHE_DIR, f".trash-{uuid.uuid4().hex}")
+    try:
+        os.rename(entry_path, trash_path)
+    except OSError:
+        # Already removed by someone else
+        return
+    if os.path.isdir(trash_path):
+        shutil.rmtree(trash_path, ignore_errors=True)
+    else:
+        try:
+            os.unlink(trash_path)
+        except OSError:
+            pass
+
+
+def evict(max_bytes: int = None, keep: str = None) -> None:
+    """
+    Evicts entries until their total size fits into max_bytes. Entries
+    are evicted in order given by CACHE_POLICY: 'lru' evicts the least
+    recently used first, 'cost' treats entry as if it was last used later
+    by the time it took to compute it, so expensive entries are kept longer.
+
+    :param max_bytes: byte budget (default CACHE_MAX_BYTES)
+    :param keep: name of entry which must not be evicted
+    """
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+    if max_bytes is None:
+        return
+
+    with _index_lock():
+        index = _read_index()
+        records = {}
+        for name in filter(_is_entry, os.listdir(CACHE_DIR)):
+            entry_path = os.path.join(CACHE_DIR, name)
+            # Entries unknown to the index are added with their mtime
+            records[name] = index.get(name) or {
+                'size': _entry_size(entry_path),
+                'cost': 0.0,
+                'last_access': os.path.getmtime(entry_path),
+            }
+
+        def priority(name):
+            record = records[name]
+            if CACHE_POLICY == 'cost':
+                return record['last_access'] + record['cost']
+            return record['last_access']
+
+        total = sum(record['size'] for record in records.values())
+        for name in sorted(records, key=priority):
+            if total <= max_bytes:
+                break
+            if name == keep:
+                continue
+            _remove_entry(os.path.join(CACHE_DIR, name))
+            total -= records.pop(name)['size']
+        _write_index(records)
+    _remove_stale_locks()
+
+
+# Name of the file describing content of a cache entry (directory)
+MANIFEST_NAME = "manifest.pkl"
+
+# Version of the cache entry format (and older ones still readable):
+# 1 -- uncompressed arrays, skeleton in the manifest, 'arrays' is a list
+#      of their filenames, or (in later entries) a dict filename -> size
+# 2 -- 'skeleton' and 'arrays' are headers of (possibly compressed) files
+ENTRY_VERSION = 2
+ENTRY_VERSIONS = (1, 2)
+
+# Smaller arrays are pickled within the manifest instead of own .npy file
+ARRAY_MIN_BYTES = 1 << 16
+
+# Directory (in CACHE_DIR) with per-entry lock files
+LOCKS_DIR = ".locks"
+
+# Expected read throughput of the disk, used when choosing codec
+DISK_BYTES_PER_SEC = 200 * 2 ** 20
+
+# Size of data sample on which the codecs are probed
+PROBE_BYTES = 1 << 20
+
+# Preference of codecs probed by codec='auto' (missing ones are skipped)
+AUTO_CODECS = ('zstd', 'lz4', 'zlib')
+
+
+class CorruptEntryError(Exception):
+    """
+    Raised when cache entry is truncated or otherwise unreadable.
+    """
+
+
+class UnsupportedEntryError(Exception):
+    """
+    Raised when cache entry is valid, but cannot be read by this code
+    (written by newer version of it, or with codec which is not installed).
+    Such entries are left for those who can read them.
+    """
+
+
+class _ArrayRef:
+    """
+    Placeholder for numpy array stored in own .npy file of a cache entry.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+
+
+def _split_arrays(obj: Any, arrays: list) -> Any:
+    """
+    Replaces large numpy arrays in (nested) tuples, lists and dicts
+    by _ArrayRef placeholders and collects them.
+
+    :param obj: result of cached function
+    :param arrays: list to which (filename, array) pairs are appended
+    :return: obj with arrays replaced by placeholders
+    """
+    import numpy as np
+
+    if type(obj) in (np.ndarray, np.memmap) and not obj.dtype.hasobject \
+            and obj.nbytes >= ARRAY_MIN_BYTES:
+        filename = f"{len(arrays)}.npy"
+        arrays.append((filename, obj))
+        return _ArrayRef(filename)
+    if type(obj) in (tuple, list):
+        return type(obj)(_split_arrays(item, arrays) for item in obj)
+    if type(obj) is dict:
+        return {key: _split_arrays(val, arrays) for key, val in obj.items()}
+    return obj
+
+
+def _join_arrays(obj: Any, load: Callable) -> Any:
+    """
+    Inverse of _split_arrays(), replaces placeholders by loaded arrays.
+
+    :param obj: object with _ArrayRef placeholders
+    :param load: function loading array from given filename
+    :return: obj with placeholders replaced
+    """
+    if isinstance(obj, _ArrayRef):
+        return load(obj.filename)
+    if type(obj) in (tuple, list):
+        return type(obj)(_join_arrays(item, load) for item in obj)
+    if type(obj) is dict:
+        return {key: _join_arrays(val, load) for key, val in obj.items()}
+    return obj
+
+
+def _get_codec(name: str) -> Tuple[Callable, Callable, int]:
+    """
+    Codecs are zlib and lzma from standard library, and lz4 and zstd
+    if the lz4 or zstandard package is installed.
+
+    :param name: name of the codec
+    :return: compress(data, level), decompress(data) and default level
+    :raise ImportError: if the codec needs package which is missing
+    """
+    if name == 'zlib':
+        import zlib
+        return zlib.compress, zlib.decompress, 6
+    if name == 'lzma':
+        import lzma
+        return (lambda data, level: lzma.compress(data, preset=level),
+                lzma.decompress, 6)
+    if name == 'lz4':
+        import lz4.frame
+        return (lambda data, level: lz4.frame.compress(data, compression_level=level),
+                lz4.frame.decompress, 0)
+    if name == 'zstd':
+        import zstandard
+        return (lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+                lambda data: zstandard.ZstdDecompressor().decompress(data), 3)
+    raise ValueError(f"Unknown codec {name}")
+
+
+def _choose_codec(data: bytes) -> str:
+    """
+    Probes the codecs from AUTO_CODECS on a sample of data and chooses
+    the one with the lowest estimated read time (reading compressed data
+    at DISK_BYTES_PER_SEC plus decompression). Raw data win ties, as
+    they can be memory-mapped.
+
+    :param data: data to be stored
+    :return: name of the codec, or None for no compression
+    """
+    from time import perf_counter
+
+    sample = bytes(data[:PROBE_BYTES])
+    if not sample:
+        return None
+    best, best_time = None, len(sample) / DISK_BYTES_PER_SEC
+    for name in AUTO_CODECS:
+        try:
+            compress, decompress, level = _get_codec(name)
+        except ImportError:
+            continue
+        compressed = compress(sample, level)
+        start = perf_counter()
+        decompress(compressed)
+        read_time = len(compressed) / DISK_BYTES_PER_SEC + perf_counter() - start
+        if read_time < best_time:
+            best, best_time = name, read_time
+    return best
+
+
+def _array_sample(arr) -> Any:
+    """
+    :param arr: numpy array
+    :return: up to PROBE_BYTES of its raw data (from the first rows)
+    """
+    import numpy as np
+
+    rows = max(1, PROBE_BYTES // max(1, arr[:1].nbytes))
+    return np.ascontiguousarray(arr[:rows]).reshape(-1).view(np.uint8)[:PROBE_BYTES]
+
+
+def _write_data(path: str, data: bytes, codec: str = None,
+                level: int = None) -> Dict[str, Any]:
+    """
+    Writes (possibly compressed) data to file.
+
+    :param path: path of the file, suffix of the codec is appended
+    :param data: data to be written
+    :param codec: name of the codec, 'auto' or None for no compression
+    :param level: compression level (default depends on codec)
+    :return: header of the file (name, size, codec and level)
+    """
+    if codec == 'auto':
+        codec = _choose_codec(data)
+    if codec is not None:
+        compress, _, default_level = _get_codec(codec)
+        level = default_level if level is None else level
+        data = compress(data, level)
+        path += '.' + codec
+    with open(path, 'wb') as f:
+        f.write(data)
+    return {'file': os.path.basename(path), 'size': len(data),
+            'codec': codec, 'level': level if codec else None}
+
+
+def _read_data(path: str, header: Dict[str, Any]) -> bytes:
+    """
+    :param path: path of the file written by _write_data()
+    :param header: header returned by _write_data()
+    :return: decompressed data
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) != header['size']:
+        raise CorruptEntryError(f"Truncated {path}")
+    if header['codec'] is None:
+        return data
+    try:
+        decompress = _get_codec(header['codec'])[1]
+    except ImportError as e:
+        raise UnsupportedEntryError(f"Missing codec for {path}: {e}") from e
+    try:
+        return decompress(data)
+    except Exception as e:
+        raise CorruptEntryError(f"Cannot decompress {path}: {e}") from e
+
+
+def _dump_entry(res: Any, entry_path: str, codec: str = None,
+                level: int = None) -> None:
+    """
+    Stores result of cached function to directory entry_path. Each large
+    numpy array in the result is saved as its own .npy file, the rest
+    of the result is pickled to the manifest.
+
+    Optionally, the arrays and the pickled rest are compressed, each with
+    codec chosen by the probe (codec='auto') or with the given one. Codec
+    and level of every file are recorded in the manifest, so the entries
+    are read back transparently. Only uncompressed arrays can be mmaped.
+
+    The entry is written to a temporary directory, which is then renamed,
+    so readers see either the whole entry or nothing. If the entry was
+    meanwhile created by someone else, the new one is discarded.
+
+    :param res: result to be stored
+    :param entry_path: directory of the entry
+    :param codec: name of the codec, 'auto' or None for no compression
+    :param level: compression level (default depends on codec)
+    """
+    import io
+    import numpy as np
+    import shutil
+    import uuid
+
+    tmp_path = os.path.join(CACHE_DIR, f".tmp-{uuid.uuid4().hex}")
+    os.mkdir(tmp_path)
+    try:
+        arrays = []
+        skeleton = _split_arrays(res, arrays)
+        headers = {}
+        for filename, arr in arrays:
+            array_path = os.path.join(tmp_path, filename)
+            array_codec = codec
+            if codec == 'auto':
+                # Probe before serializing, raw arrays go straight to file
+                array_codec = _choose_codec(_array_sample(arr))
+            if array_codec is None:
+                np.save(array_path, arr, allow_pickle=False)
+                headers[filename] = {
+                    'file': filename, 'size': os.path.getsize(array_path),
+                    'codec': None, 'level': None,
+                }
+            else:
+                buffer = io.BytesIO()
+                np.save(buffer, arr, allow_pickle=False)
+                headers[filename] = _write_data(
+                    array_path, buffer.getbuffer(), array_codec, level
+                )
+                del buffer
+
+        skeleton_header = _write_data(
+            os.path.join(tmp_path, "skeleton.pkl"),
+            pickle.dumps(skeleton), codec, level
+        )
+        manifest = {
+            'version': ENTRY_VERSION,
+            'skeleton': skeleton_header,
+            'arrays': headers,
+        }
+        with open(os.path.join(tmp_path, MANIFEST_NAME), 'wb') as f:
+            pickle.dump(manifest, f)
+        os.rename(tmp_path, entry_path)
+    except OSError:
+        if not os.path.isdir(entry_path):
+            raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _unpickle(data, path: str) -> Any:
+    """
+    :param data: pickled bytes or file opened for reading
+    :param path: path of the pickle (for error message)
+    :return: unpickled object
+    :raise CorruptEntryError: if the pickle is truncated or garbled
+    """
+    try:
+        if isinstance(data, (bytes, bytearray)):
+            return pickle.loads(data, encoding="bytes")
+        return pickle.load(data, encoding="bytes")
+    except (EOFError, pickle.UnpicklingError, ValueError) as e:
+        raise CorruptEntryError(f"Cannot unpickle {path}: {e}") from e
+
+
+def _entry_headers(manifest: Dict, entry_path: str) -> Tuple[Any, Dict]:
+    """
+    Reads skeleton of the result and headers of its array files for any
+    of the layouts of the manifest (see ENTRY_VERSIONS).
+
+    :param manifest: content of the manifest
+    :param entry_path: directory of the entry
+    :return: skeleton and headers (filename -> file, size, codec)
+    """
+    version = manifest['version']
+    if version == 1:
+        skeleton = manifest['skeleton']
+        if isinstance(manifest['arrays'], dict):
+            sizes = manifest['arrays']
+        else:
+            # The first layout has no sizes of the arrays
+            sizes = dict.fromkeys(manifest['arrays'])
+        headers = {
+            filename: {'file': filename, 'size': size, 'codec': None}
+            for filename, size in sizes.items()
+        }
+        return skeleton, headers
+    skeleton_path = os.path.join(entry_path, manifest['skeleton']['file'])
+    skeleton = _unpickle(_read_data(skeleton_path, manifest['skeleton']),
+                         skeleton_path)
+    return skeleton, manifest['arrays']
+
+
+def _load_entry(entry_path: str, mmap: bool = True) -> Any:
+    """
+    Loads result stored by _dump_entry(). With mmap, arrays are returned
+    as read-only memory maps, i.e. they are read lazily and their pages
+    are shared between processes through the OS page cache.
+
+    :param entry_path: directory of the entry
+    :param mmap: whether to memory-map the arrays
+    :return: stored result
+    :raise FileNotFoundError: if the entry does not exist (anymore)
+    :raise CorruptEntryError: if the entry is truncated or unreadable
+    :raise UnsupportedEntryError: if the entry is valid, but cannot be read
+                                  here (newer version, missing codec)
+    """
+    import io
+    import numpy as np
+
+    if os.path.isfile(entry_path):
+        # Entry in the old format, i.e. plain pickle
+        with open(entry_path, 'rb') as cache_file:
+            return _unpickle(cache_file, entry_path)
+
+    manifest_path = os.path.join(entry_path, MANIFEST_NAME)
+    with open(manifest_path, 'rb') as f:
+        manifest = _unpickle(f, manifest_path)
+    if not isinstance(manifest, dict) or 'version' not in manifest:
+        raise CorruptEntryError(f"Invalid manifest of {entry_path}")
+    if manifest['version'] not in ENTRY_VERSIONS:
+        raise UnsupportedEntryError(
+            f"Unsupported version {manifest['version']} of {entry_path}"
+        )
+
+    skeleton, headers = _entry_headers(manifest, entry_path)
+    for header in headers.values():
+        file_path = os.path.join(entry_path, header['file'])
+        if header['size'] is not None and os.path.getsize(file_path) != header['size']:
+            raise CorruptEntryError(f"Truncated {file_path}")
+
+    def load(filename):
+        header = headers[filename]
+        file_path = os.path.join(entry_path, header['file'])
+        try:
+            if header['codec'] is None:
+                return np.load(file_path, mmap_mode='r' if mmap else None,
+                               allow_pickle=False)
+            return np.load(io.BytesIO(_read_data(file_path, header)),
+                           allow_pickle=False)
+        except ValueError as e:
+            raise CorruptEntryError(f"Cannot read {file_path}: {e}") from e
+    return _join_arrays(skeleton, load)
+
+
+# Marks missing result of cached function (None is a valid result)
+_MISS = object()
+
+
+class CacheStats:
+    """
+    Counters of a cached function: hits (from memory and disk), misses,
+    seconds spent computing, loading and serializing results, and bytes
+    written to and read from disk. Note that memory-mapped results are
+    read lazily, so their load time covers only opening the entry.
+    """
+    FIELDS = ('memory_hits', 'disk_hits', 'misses', 'compute_time',
+              'load_time', 'serialize_time', 'bytes_written', 'bytes_read')
+
+    def __init__(self, name: str):
+        """
+        :param name: name of the cached function
+        """
+        self.name = name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def add(self, **values) -> None:
+        """
+        :param values: increments of the counters (see FIELDS)
+        """
+        with self._lock:
+            for field, value in values.items():
+                setattr(self, field, getattr(self, field) + value)
+
+    def reset(self) -> None:
+        """
+        Sets all counters to zero.
+        """
+        with self._lock:
+            for field in self.FIELDS:
+                setattr(self, field, 0)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        :return: the counters together with average times
+        """
+        with self._lock:
+            stats = {field: getattr(self, field) for field in self.FIELDS}
+        stats['avg_compute_time'] = \
+            stats['compute_time'] / stats['misses'] if stats['misses'] else None
+        stats['avg_load_time'] = \
+            stats['load_time'] / stats['disk_hits'] if stats['disk_hits'] else None
+        stats['avg_serialize_time'] = \
+            stats['serialize_time'] / stats['misses'] if stats['misses'] else None
+        return stats
+
+
+# Statistics of all functions decorated with cache(), by their name
+_STATS = {}
+
+# Current code fingerprints of all functions decorated with cache()
+_FINGERPRINTS = {}
+
+
+def _stats_for(function: Callable) -> CacheStats:
+    """
+    :param function: cached function
+    :return: its (newly registered) statistics
+    """
+    name = _qualified_name(function)
+    stats = _STATS[name] = CacheStats(name)
+    return stats
+
+
+def stale_entries() -> Dict[str, list]:
+    """
+    Finds entries that became unreachable, because the code of their
+    function (or of project code it uses) changed since they were stored.
+    Only functions decorated in this process can be checked.
+
+    :return: name of function -> names of its stale entries
+    """
+    stale = {}
+    for name, record in _read_index().items():
+        function = record.get('function')
+        if function in _FINGERPRINTS and \
+                record.get('fingerprint') != _FINGERPRINTS[function]():
+            stale.setdefault(function, []).append(name)
+    return stale
+
+
+def invalidate_stale(verbose: bool = True) -> Dict[str, list]:
+    """
+    Removes stale entries (see stale_entries) and reports them.
+
+    :param verbose: print the removed entries
+    :return: name of function -> names of its removed entries
+    """
+    stale = stale_entries()
+    for function, names in stale.items():
+        if verbose:
+            print(f"-- Code of {function} changed, removing {len(names)} entries:")
+        for name in names:
+            if verbose:
+                print(f"   {name}")
+            _remove_entry(os.path.join(CACHE_DIR, name))
+
+    with _index_lock():
+        index = _read_index()
+        for names in stale.values():
+            for name in names:
+                index.pop(name, None)
+        _write_index(index)
+    return stale
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    :return: statistics (see CacheStats.as_dict) of all cached functions
+    """
+    return {name: stats.as_dict() for name, stats in _STATS.items()}
+
+
+def reset_stats() -> None:
+    """
+    Resets statistics of all cached functions.
+    """
+    for stats in _STATS.values():
+        stats.reset()
+
+
+def cache_report(fmt: str = 'table') -> str:
+    """
+    Report of statistics of all cached functions, e.g. to find out
+    whether loading an entry is actually faster than recomputing it.
+    The table shows average times per call.
+
+    :param fmt: 'table' for human-readable table, or 'json'
+    :return: the report
+    """
+    import json
+
+    stats = cache_stats()
+    if fmt == 'json':
+        return json.dumps(stats, indent=2)
+    if fmt != 'table':
+        raise ValueError(f"Unknown format {fmt}")
+
+    def seconds(value):
+        return '-' if value is None else f"{value:.3f}"
+
+    header = f"{'function':40} {'mem':>5} {'disk':>5} {'miss':>5} " \
+             f"{'compute s':>10} {'load s':>8} {'save s':>8} {'written MB':>10}"
+    lines = [header, '-' * len(header)]
+    for name, row in sorted(stats.items()):
+        lines.append(
+            f"{name[-40:]:40} {row['memory_hits']:5} {row['disk_hits']:5} "
+            f"{row['misses']:5} {seconds(row['avg_compute_time']):>10} "
+            f"{seconds(row['avg_load_time']):>8} "
+            f"{seconds(row['avg_serialize_time']):>8} "
+            f"{row['bytes_written'] / 2 ** 20:10.1f}"
+        )
+    return '\n'.join(lines)
+
+
+# Statistics of in-memory cache returned by cache_info()
+CacheInfo = namedtuple(
+    'CacheInfo', ['hits', 'misses', 'max_entries', 'max_bytes', 'entries', 'nbytes']
+)
 
 
-def cache(function: Callable, verbose: bool = True) -> Callable:
+def _nbytes(obj: Any) -> int:
+    """
+    Estimates memory occupied by obj. Arrays are counted by their nbytes
+    (memory-mapped ones are backed by file and counted as 0), containers
+    by the sum of their items.
+
+    :param obj: object to be measured
+    :return: estimated size in bytes
+    """
+    import sys
+    import numpy as np
+
+    if isinstance(obj, np.memmap):
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        return sys.getsizeof(obj) + sum(_nbytes(item) for item in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(
+            _nbytes(key) + _nbytes(val) for key, val in obj.items()
+        )
+    return sys.getsizeof(obj)
+
+
+def _arrays_in(obj: Any, found: Dict[int, Any], seen: set) -> None:
+    """
+    Collects numpy arrays in obj, i.e. in (nested) tuples, lists, dicts,
+    sets and attributes of objects.
+
+    :param obj: object to be searched
+    :param found: id of array -> array, updated
+    :param seen: ids of visited objects (to stop on cycles)
+    """
+    import numpy as np
+
+    if isinstance(obj, np.ndarray):
+        found[id(obj)] = obj
+        return
+    if obj is None or isinstance(obj, (str, bytes, int, float)) or id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, dict):
+        items = list(obj.values())
+    elif isinstance(obj, (tuple, list, set, frozenset)):
+        items = list(obj)
+    elif hasattr(obj, '__dict__') and not callable(obj):
+        items = list(vars(obj).values())
+    else:
+        return
+    for item in items:
+        _arrays_in(item, found, seen)
+
+
+def _freeze(value: Any) -> Tuple[Any, Dict[int, Any]]:
+    """
+    Copy of value to be kept in memory cache, in which numpy arrays are
+    replaced by read-only views of them (their data are not copied).
+
+    :param value: result of cached function
+    :return: the copy and memo of copy.deepcopy sharing the views (see _thaw),
+             or value itself and None if it cannot be copied
+    """
+    import copy
+
+    arrays = {}
+    _arrays_in(value, arrays, set())
+    views = []
+    for arr in arrays.values():
+        view = arr.view()
+        view.setflags(write=False)
+        views.append(view)
+    try:
+        frozen = copy.deepcopy(value, dict(zip(arrays, views)))
+    except (TypeError, copy.Error):
+        return value, None
+    return frozen, {id(view): view for view in views}
+
+
+def _thaw(frozen: Any, memo: Dict[int, Any]) -> Any:
+    """
+    :param frozen: value stored in memory cache (see _freeze)
+    :param memo: memo sharing its read-only arrays
+    :return: copy of the value for the caller, with the arrays shared
+    """
+    import copy
+
+    if memo is None or id(frozen) in memo:
+        return frozen
+    return copy.deepcopy(frozen, dict(memo))
+
+
+# All memory caches, cleared by clear_cache()
+_MEMORY_CACHES = weakref.WeakSet()
+
+
+class _MemoryCache:
+    """
+    Thread-safe in-memory LRU cache bounded by number of entries and by
+    their estimated size. Concurrent misses on the same key compute
+    the value only once (the other callers wait for it).
+
+    Each caller gets its own copy of the value, so changing it does not
+    change the cache. Numpy arrays are not copied, but returned as
+    read-only views (see _freeze).
+    """
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None):
+        """
+        :param max_entries: maximal number of entries (None for no limit)
+        :param max_bytes: maximal total size of entries (None for no limit)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (frozen value, memo, nbytes)
+        self._pending = {}  # key -> Event set when computation ends
+        self._lock = threading.Lock()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        _MEMORY_CACHES.add(self)
+
+    def _hit(self, key: str) -> Tuple[Any, Dict[int, Any]]:
+        # Must be called with the lock held
+        self._data.move_to_end(key)
+        self.hits += 1
+        return self._data[key][:2]
+
+    def get(self, key: str) -> Any:
+        """
+        :param key: key of the entry
+        :return: copy of cached value or _MISS
+        """
+        with self._lock:
+            if key not in self._data:
+                return _MISS
+            frozen, memo = self._hit(key)
+        return _thaw(frozen, memo)
+
+    def put(self, key: str, value: Any) -> Any:
+        """
+        Stores value and evicts least recently used entries over limits.
+        Values larger than max_bytes alone are not stored at all.
+
+        :param key: key of the entry
+        :param value: value to be stored
+        :return: copy of the value for the caller (value if not stored)
+        """
+        size = _nbytes(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return value
+        frozen, memo = _freeze(value)
+        with self._lock:
+            if key in self._data:
+                self._nbytes -= self._data.pop(key)[2]
+            self._data[key] = (frozen, memo, size)
+            self._nbytes += size
+            while (self.max_entries is not None and len(self._data) > self.max_entries) \
+                    or (self.max_bytes is not None and self._nbytes > self.max_bytes):
+                self._nbytes -= self._data.popitem(last=False)[1][2]
+        return _thaw(frozen, memo)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        """
+        :param key: key of the entry
+        :param compute: computes the value on miss
+        :return: copy of cached or computed value
+        """
+        while True:
+            with self._lock:
+                if key in self._data:
+                    frozen, memo = self._hit(key)
+                    return _thaw(frozen, memo)
+                event = self._pending.get(key)
+                if event is None:
+                    event = self._pending[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Someone else computes it, wait and look again
+            event.wait()
+
+        try:
+            return self.put(key, compute())
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+    def info(self) -> CacheInfo:
+        """
+        :return: statistics of the cache
+        """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.max_entries,
+                             self.max_bytes, len(self._data), self._nbytes)
+
+    def clear(self) -> None:
+        """
+        Removes all entries and resets the statistics.
+        """
+        with self._lock:
+            self._data.clear()
+            self._nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+def _lock_path(name: str) -> str:
+    """
+    :param name: name of the entry
+    :return: path of lock file guarding computation of the entry
+    """
+    locks_dir = os.path.join(CACHE_DIR, LOCKS_DIR)
+    os.makedirs(locks_dir, exist_ok=True)
+    return os.path.join(locks_dir, name + ".lock")
+
+
+def _remove_stale_locks() -> None:
+    """
+    Removes unused lock files of entries that do not exist (anymore).
+    """
+    locks_dir = os.path.join(CACHE_DIR, LOCKS_DIR)
+    if not os.path.isdir(locks_dir):
+        return
+    for file_name in os.listdir(locks_dir):
+        name = file_name[:-len(".lock")]
+        if file_name.endswith(".lock") and \
+                not os.path.exists(os.path.join(CACHE_DIR, name)):
+            _remove_lock(os.path.join(locks_dir, file_name))
+
+
+class Backend(ABC):
+    """
+    Shared storage of cache entries (directories of files), which is
+    consulted when an entry is missing in the local CACHE_DIR and to which
+    newly computed entries are uploaded. Set CACHE_BACKEND to use one.
+
+    Note that fetched entries are unpickled, so the backend (and anyone
+    who can write to it) must be trusted.
+    """
+
+    @abstractmethod
+    def fetch(self, name: str, dest_path: str) -> bool:
+        """
+        Downloads entry into (not existing) directory dest_path.
+
+        :param name: name of the entry
+        :param dest_path: directory to be created with files of the entry
+        :return: False if the backend does not have the entry
+        """
+
+    @abstractmethod
+    def store(self, name: str, entry_path: str) -> None:
+        """
+        Uploads entry from local directory.
+
+        :param name: name of the entry
+        :param entry_path: directory with files of the entry
+        """
+
+
+def _file_digest(path: str) -> str:
+    """
+    :param path: path of file
+    :return: sha256 of the file content in hex representation
+    """
+    from hashlib import sha256
+    m = sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            m.update(block)
+    return m.hexdigest()
+
+
+class LocalBackend(Backend):
+    """
+    Entries stored in a directory, e.g. on a network file system
+    shared by more machines.
+    """
+
+    def __init__(self, root: str):
+        """
+        :param root: directory with the shared entries
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def fetch(self, name: str, dest_path: str) -> bool:
+        import shutil
+        entry_path = os.path.join(self.root, name)
+        if not os.path.isdir(entry_path):
+            return False
+        shutil.copytree(entry_path, dest_path)
+        return True
+
+    def store(self, name: str, entry_path: str) -> None:
+        import shutil
+        import uuid
+        tmp_path = os.path.join(self.root, f".tmp-{uuid.uuid4().hex}")
+        shutil.copytree(entry_path, tmp_path)
+        try:
+            os.rename(tmp_path, os.path.join(self.root, name))
+        except OSError:
+            # Stored by someone else in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _sign_ref(token: str, name: str, files: Dict[str, str]) -> str:
+    """
+    :param token: shared secret
+    :param name: name of the entry
+    :param files: filename -> sha256 of the files of the entry
+    :return: HMAC-SHA256 of the entry name and its files
+    """
+    import hmac
+    import json
+    from hashlib import sha256
+
+    message = json.dumps({'name': name, 'files': files}, sort_keys=True)
+    return hmac.new(token.encode('utf-8'), message.encode('utf-8'), sha256).hexdigest()
+
+
+# Environment variable with the token shared by HTTPBackend clients
+# and cache_server.py
+TOKEN_ENV = "CACHE_SERVER_TOKEN"
+
+
+def _check_ref_files(name: str, files: Any) -> Dict[str, str]:
+    """
+    Checks that files of fetched ref are plain file names with sha256
+    digests, so writing them cannot leave the directory of the entry.
+
+    :param name: name of the entry
+    :param files: filename -> sha256 from the ref
+    :return: files
+    :raise CorruptEntryError: if any filename or digest is not valid
+    """
+    import re
+
+    if not isinstance(files, dict):
+        raise CorruptEntryError(f"Invalid list of files of {name}")
+    for filename, digest in files.items():
+        if not isinstance(filename, str) or not filename \
+                or filename.startswith('.') or os.sep in filename \
+                or (os.altsep and os.altsep in filename) \
+                or filename != os.path.basename(filename):
+            raise CorruptEntryError(f"Invalid file name {filename!r} of {name}")
+        if not isinstance(digest, str) or not re.fullmatch(r'[0-9a-f]{64}', digest):
+            raise CorruptEntryError(f"Invalid digest {digest!r} of {name}")
+    return files
+
+
+class HTTPBackend(Backend):
+    """
+    Entries stored on HTTP server (see cache_server.py) speaking
+    a simple protocol. Files are content-addressed by their sha256,
+    so equal files are uploaded and stored only once:
+
+    * GET/HEAD/PUT /blobs/<sha256> -- content of a file
+    * GET/PUT /refs/<name> -- JSON {"files": {filename: sha256},
+      "signature": HMAC of the name and files} of an entry
+
+    With a token (shared secret), uploads are authorized by it and every
+    fetched ref must carry a valid signature made with it, so entries
+    written by anyone else are rejected before anything is unpickled.
+    Without a token, refs are not verified and the server must be trusted.
+
+    Files are streamed in both directions, never held in memory whole.
+    """
+
+    def __init__(self, url: str, timeout: float = 60, token: str = None):
+        """
+        :param url: base url of the server, e.g. http://host:8765
+        :param timeout: timeout of requests in seconds
+        :param token: shared secret (default from environment variable TOKEN_ENV)
+        """
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.token = token if token is not None else os.environ.get(TOKEN_ENV)
+
+    def _request(self, method: str, path: str, data=None, headers=None):
+        import urllib.request
+        headers = dict(headers or {})
+        if self.token is not None:
+            headers['Authorization'] = f"Bearer {self.token}"
+        request = urllib.request.Request(
+            self.url + path, data=data, method=method, headers=headers
+        )
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def _verify(self, name: str, ref: Dict) -> Dict[str, str]:
+        """
+        :param name: name of the entry
+        :param ref: fetched ref of the entry
+        :return: filename -> sha256 of its files
+        :raise CorruptEntryError: if the signature is missing or invalid
+        """
+        import hmac
+
+        if 'files' not in ref:
+            # Unsigned ref of older clients
+            if self.token is not None:
+                raise CorruptEntryError(f"Unsigned ref of {name} on {self.url}")
+            return ref
+        if self.token is not None and not hmac.compare_digest(
+                str(ref.get('signature')), _sign_ref(self.token, name, ref['files'])):
+            raise CorruptEntryError(f"Invalid signature of {name} on {self.url}")
+        return ref['files']
+
+    def _exists(self, path: str) -> bool:
+        import urllib.error
+        try:
+            with self._request('HEAD', path):
+                return True
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+
+    def fetch(self, name: str, dest_path: str) -> bool:
+        import json
+        import shutil
+        import urllib.error
+        from hashlib import sha256
+        from urllib.parse import quote
+
+        try:
+            with self._request('GET', '/refs/' + quote(name, safe='')) as response:
+                ref = json.load(response)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+        except ValueError as e:
+            raise CorruptEntryError(f"Invalid ref of {name} on {self.url}") from e
+        files = _check_ref_files(name, self._verify(name, ref))
+
+        os.mkdir(dest_path)
+        root = os.path.realpath(dest_path)
+        for filename, digest in files.items():
+            file_path = os.path.join(dest_path, filename)
+            if os.path.dirname(os.path.realpath(file_path)) != root:
+                raise CorruptEntryError(f"Invalid file name {filename!r} of {name}")
+            # Hidden until its content is verified
+            part_path = os.path.join(dest_path, f".{filename}.part")
+            m = sha256()
+            with self._request('GET', '/blobs/' + digest) as response, \
+                    open(part_path, 'wb') as f:
+                for block in iter(lambda: response.read(1 << 20), b''):
+                    m.update(block)
+                    f.write(block)
+            if m.hexdigest() != digest:
+                shutil.rmtree(dest_path, ignore_errors=True)
+                raise CorruptEntryError(f"Corrupt {filename} of {name} on {self.url}")
+            os.replace(part_path, file_path)
+        return True
+
+    def store(self, name: str, entry_path: str) -> None:
+        import json
+        from urllib.parse import quote
+
+        files = {}
+        for filename in sorted(os.listdir(entry_path)):
+            file_path = os.path.join(entry_path, filename)
+            digest = files[filename] = _file_digest(file_path)
+            if self._exists('/blobs/' + digest):
+                continue
+            with open(file_path, 'rb') as f:
+                headers = {'Content-Length': str(os.path.getsize(file_path))}
+                self._request('PUT', '/blobs/' + digest, f, headers).close()
+
+        ref = {'files': files}
+        if self.token is not None:
+            ref['signature'] = _sign_ref(self.token, name, files)
+        data = json.dumps(ref).encode('utf-8')
+        self._request('PUT', '/refs/' + quote(name, safe=''), data,
+                      {'Content-Type': 'application/json'}).close()
+
+
+# Shared storage of entries (see Backend), None to use only CACHE_DIR
+CACHE_BACKEND = None
+
+
+def _fetch_entry(name: str, cache_path: str, verbose: bool) -> bool:
+    """
+    Downloads entry from CACHE_BACKEND into CACHE_DIR.
+
+    :param name: name of the entry
+    :param cache_path: local path of the entry
+    :param verbose: print info about download
+    :return: whether the entry was downloaded
+    """
+    import shutil
+    import uuid
+
+    if CACHE_BACKEND is None:
+        return False
+    tmp_path = os.path.join(CACHE_DIR, f".tmp-{uuid.uuid4().hex}")
+    try:
+        if not CACHE_BACKEND.fetch(name, tmp_path):
+            return False
+        if verbose:
+            print(f"-- Downloaded {name} from shared cache")
+        os.rename(tmp_path, cache_path)
+        return True
+    except (OSError, CorruptEntryError) as e:
+        if verbose:
+            print(f"-- Cannot download {name} from shared cache ({e})")
+        return os.path.isdir(cache_path)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _store_entry(name: str, cache_path: str, verbose: bool) -> None:
+    """
+    Uploads entry from CACHE_DIR to CACHE_BACKEND (failures are ignored).
+
+    :param name: name of the entry
+    :param cache_path: local path of the entry
+    :param verbose: print info about upload
+    """
+    if CACHE_BACKEND is None or not os.path.isdir(cache_path):
+        return
+    try:
+        CACHE_BACKEND.store(name, cache_path)
+    except OSError as e:
+        if verbose:
+            print(f"-- Cannot upload {name} to shared cache ({e})")
+
+
+# Number of threads computing results in background (see prefetch)
+BACKGROUND_WORKERS = 2
+
+# Executor of background computations, created on first use
+_EXECUTOR = None
+
+# Futures of running background computations, name of entry -> Future
+_IN_FLIGHT = {}
+_IN_FLIGHT_LOCK = threading.Lock()
+
+
+def _in_submitted_context(run: Callable[[], Any]) -> Callable[[], Any]:
+    """
+    :param run: computation submitted to background thread
+    :return: run with key contexts set to their current values
+             (see add_key_context)
+    """
+    from contextlib import ExitStack
+
+    captured = [(apply, context()) for context, apply in _KEY_CONTEXT_APPLY.items()]
+
+    def run_in_context():
+        with ExitStack() as stack:
+            for apply, value in captured:
+                stack.enter_context(apply(value))
+            return run()
+    return run_in_context
+
+
+def _submit(name: str, run: Callable[[], Any]):
+    """
+    Runs computation of entry in background, unless it already runs.
+    Key contexts (e.g. precision) keep the values they have now,
+    as the name of the entry does.
+
+    :param name: name of the entry
+    :param run: loads or computes the entry
+    :return: concurrent.futures.Future of the result
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    global _EXECUTOR
+
+    with _IN_FLIGHT_LOCK:
+        if name in _IN_FLIGHT:
+            return _IN_FLIGHT[name]
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS)
+        future = _IN_FLIGHT[name] = _EXECUTOR.submit(_in_submitted_context(run))
+
+    def done(_):
+        with _IN_FLIGHT_LOCK:
+            _IN_FLIGHT.pop(name, None)
+    future.add_done_callback(done)
+    return future
+
+
+def prefetch(function: Callable, *args, **kwargs):
+    """
+    Starts computing (or loading) result of cached function in background,
+    so that it is ready (in memory and on disk) when it is needed. Calling
+    the function with the same arguments meanwhile waits only for the
+    remaining work.
+
+    :param function: function decorated with cache()
+    :param args: its arguments
+    :param kwargs: its key-word arguments
+    :return: concurrent.futures.Future of the result
+    """
+    if not hasattr(function, 'prefetch'):
+        raise TypeError(f"{function} is not decorated with cache()")
+    return function.prefetch(*args, **kwargs)
+
+
+def cache(function: Callable = None, verbose: bool = True, mmap: bool = True,
+          memory_entries: int = 8, memory_bytes: int = 1 << 30,
+          codec: str = None, level: int = None,
+          background: bool = False) -> Callable:
     """
     cache() serves as a decorator for function which takes
     long time to compute and is likely to be used multiple times.
@@ -85,59 +1915,219 @@ def cache(function: Callable, verbose: bool = True) -> Callable:
     passed function name and arguments. Following calls will result
     in loading the result from FS.
 
+    Large numpy arrays in the result (also inside tuples, lists and
+    dicts) are stored as .npy files and by default loaded memory-mapped,
+    i.e. read-only. Can be used both as @cache and @cache(mmap=False).
+
+    The disk is fronted by in-memory tier (see cache_on_the_fly): computed
+    results are kept in memory and written through to disk, results loaded
+    from disk are promoted to memory. Repeated calls within one session
+    then cost nothing. Each call returns its own copy of the result, with
+    numpy arrays shared as read-only views.
+    The memory tier has cache_info() and cache_clear() attached,
+    cache_stats() returns hit/miss counts and timings of the function
+    (see also cache_report()).
+
     :param function: function that takes long time to compute
     :param verbose: print info whether cached or not
+    :param mmap: load the cached arrays as read-only np.memmap
+    :param memory_entries: maximal number of results in memory (0 disables
+                           the memory tier, None for no limit)
+    :param memory_bytes: maximal size of results in memory (memory-mapped
+                         arrays are not counted), None for no limit
+    :param codec: compression of entries: None, 'auto' (chosen for each
+                  file by a quick probe, see _choose_codec) or one of
+                  'zlib', 'lzma', 'lz4', 'zstd' (see _get_codec)
+    :param level: compression level (default depends on codec)
+    :param background: return immediately concurrent.futures.Future
+                       of the result, computed in background (see prefetch)
     :return: cached or first-time computed result of function
 
+    When the total size of entries exceeds CACHE_MAX_BYTES, the entries
+    are evicted according to CACHE_POLICY (see evict()).
+
+    The entries are keyed also by fingerprint of the code of function
+    and of the project code it calls, so changing the code makes its old
+    entries unreachable (see stale_entries() and invalidate_stale()).
+
+    When CACHE_BACKEND is set, entries missing locally are downloaded
+    from it, and newly computed entries are uploaded to it, so results
+    are shared between machines (see Backend).
+
+    Safe to use from multiple processes: entries are written atomically,
+    and when several callers miss on the same entry, the first computes
+    it while the others wait and then load it. Corrupt entries are
+    detected and recomputed.
+
     Note: it must be possible to pickle.dump() the result
     """
-    def load_or_run(*args, **kwargs):
-        # Prepare path with cached result
-        cache_path = os.path.join(
-            CACHE_DIR, _create_name(function, args, kwargs)
-        )
+    from functools import partial, wraps
+
+    if function is None:
+        return partial(cache, verbose=verbose, mmap=mmap,
+                       memory_entries=memory_entries, memory_bytes=memory_bytes,
+                       codec=codec, level=level, background=background)
+
+    memory = _MemoryCache(memory_entries, memory_bytes)
+    stats = _stats_for(function)
+    qualified_name = stats.name
+    fingerprint = []  # computed on the first call, when all code is loaded
+
+    def version() -> str:
+        if not fingerprint:
+            fingerprint.append(_fingerprint(function))
+        return fingerprint[0]
+    _FINGERPRINTS[qualified_name] = version
 
-        # If the file exists, the result is there
-        if os.path.exists(cache_path):
+    def try_load(name: str, cache_path: str) -> Any:
+        from time import perf_counter
+
+        # Returns the stored result, or _MISS if there is no valid one
+        if not os.path.exists(cache_path):
+            return _MISS
+        if verbose:
+            print(f"-- Loading result from {cache_path}")
+        try:
+            start = perf_counter()
+            res = _load_entry(cache_path, mmap)
+            stats.add(disk_hits=1, load_time=perf_counter() - start,
+                      bytes_read=_entry_size(cache_path))
+        except FileNotFoundError:
+            # Evicted in the meantime, compute it again
+            return _MISS
+        except CorruptEntryError as e:
             if verbose:
-                print(f"-- Loading result from {cache_path}")
+                print(f"-- Recomputing corrupt entry ({e})")
+            _remove_entry(cache_path)
+            return _MISS
+        except UnsupportedEntryError as e:
+            if verbose:
+                print(f"-- Recomputing, cannot read entry ({e})")
+            return _MISS
+        _touch_entry(name)
+        return res
 
-            # Open file and return its pickled content
-            with open(cache_path, 'rb') as cache_file:
-                res = pickle.load(cache_file, encoding="bytes")
+    def load_or_run_disk(name: str, args: Tuple, kwargs: Dict) -> Any:
+        from time import perf_counter
+
+        # Prepare path with cached result
+        cache_path = os.path.join(CACHE_DIR, name)
+
+        # If the entry exists, the result is there
+        res = try_load(name, cache_path)
+        if res is not _MISS:
             return res
 
-        # If file does not exist, calculate the result and store it
-        res = function(*args, **kwargs)
+        # Only one caller computes the result, the others wait for it
+        with _FileLock(_lock_path(name)):
+            res = try_load(name, cache_path)
+            if res is not _MISS:
+                return res
+
+            # Maybe someone else has already computed it
+            if _fetch_entry(name, cache_path, verbose):
+                _touch_entry(name, size=_entry_size(cache_path),
+                             function=qualified_name, fingerprint=version())
+                res = try_load(name, cache_path)
+                if res is not _MISS:
+                    return res
 
-        # Write the result to disk
-        with open(cache_path, 'wb') as f:
+            # If entry does not exist, calculate the result and store it
+            start = perf_counter()
+            res = function(*args, **kwargs)
+            cost = perf_counter() - start
+
+            # Write the result to disk
             if verbose:
                 print(f"-- Saving result to {cache_path}")
-            pickle.dump(res, f)
+            start = perf_counter()
+            _dump_entry(res, cache_path, codec, level)
+            size = _entry_size(cache_path)
+            stats.add(misses=1, compute_time=cost, bytes_written=size,
+                      serialize_time=perf_counter() - start)
+            _touch_entry(name, size=size, cost=cost,
+                         function=qualified_name, fingerprint=version())
+            _store_entry(name, cache_path, verbose)
+        evict(keep=name)
 
         # Finally return computed things
         return res
+
+    def run(name: str, args: Tuple, kwargs: Dict) -> Any:
+        if memory_entries == 0:
+            return load_or_run_disk(name, args, kwargs)
+
+        res = memory.get(name)
+        if res is not _MISS:
+            if verbose:
+                print(f"-- Loading result of {function.__name__} from memory")
+            stats.add(memory_hits=1)
+            return res
+        return memory.get_or_compute(
+            name, lambda: load_or_run_disk(name, args, kwargs)
+        )
+
+    def prefetch_run(*args, **kwargs):
+        name = _create_name(function, args, kwargs, version())
+        return _submit(name, lambda: run(name, args, kwargs))
+
+    @wraps(function)
+    def load_or_run(*args, **kwargs):
+        if background:
+            return prefetch_run(*args, **kwargs)
+        name = _create_name(function, args, kwargs, version())
+
+        # Wait for the computation running in background, if any
+        with _IN_FLIGHT_LOCK:
+            future = _IN_FLIGHT.get(name)
+        if future is not None:
+            return future.result()
+        return run(name, args, kwargs)
+
+    load_or_run.prefetch = prefetch_run
+    load_or_run.cache_info = memory.info
+    load_or_run.cache_clear = memory.clear
+    load_or_run.cache_stats = stats.as_dict
     return load_or_run
 
 
-def cache_on_the_fly(function: Callable, verbose: bool = False) -> Callable:
+def cache_on_the_fly(function: Callable = None, verbose: bool = False,
+                     max_entries: int = 128, max_bytes: int = None) -> Callable:
     """
-    Caches the result of function in dictionary.
+    Caches the result of function in memory. The least recently used
+    results are dropped when there are more than max_entries of them, or
+    when their estimated size exceeds max_bytes. Thread-safe, concurrent
+    calls with the same arguments compute the result only once.
+
+    The decorated function has cache_info() and cache_clear() attached.
+    Can be used both as @cache_on_the_fly and @cache_on_the_fly(...).
 
     :param function: function doing expensive operation
     :param verbose: print whether cached
+    :param max_entries: maximal number of results (None for no limit)
+    :param max_bytes: maximal total size of results (None for no limit)
     :return: cached or first-time computed result of function
     """
-    cached_result = {}
+    from functools import partial, wraps
+
+    if function is None:
+        return partial(cache_on_the_fly, verbose=verbose,
+                       max_entries=max_entries, max_bytes=max_bytes)
+
+    memory = _MemoryCache(max_entries, max_bytes)
 
+    @wraps(function)
     def load_or_run(*args, **kwargs):
         name = _create_name(function, args, kwargs)
-        if name not in cached_result:
-            cached_result[name] = function(*args, **kwargs)
-        elif verbose:
-            print(f"-- Loading from cache")            
-        return cached_result[name]
+        res = memory.get(name)
+        if res is not _MISS:
+            if verbose:
+                print(f"-- Loading from cache")
+            return res
+        return memory.get_or_compute(name, lambda: function(*args, **kwargs))
+
+    load_or_run.cache_info = memory.info
+    load_or_run.cache_clear = memory.clear
     return load_or_run
 
 
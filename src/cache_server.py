@@ -0,0 +1,167 @@
+"""
+In this file, we define a tiny HTTP server, which stores cache entries
+shared by more machines (see cache.HTTPBackend for the protocol).
+It serves as a local stand-in of an object store. Files (blobs) are
+stored by their sha256 in <root>/blobs, entries (refs) as JSON mapping
+of their file names to blobs in <root>/refs.
+
+Clients unpickle the entries they fetch, so whoever can upload to the
+server can run code on them. Uploads (PUT) are therefore accepted only
+with the shared token (see --token), or without a token only from the
+allowed addresses (loopback by default). Clients with the token also
+verify signatures of the refs (see cache.HTTPBackend). Downloads are
+not authenticated, keep the server off untrusted networks.
+
+Usage: CACHE_SERVER_TOKEN=<secret> python cache_server.py --root ../cache_shared
+and then in the client (with the same CACHE_SERVER_TOKEN set):
+cache.CACHE_BACKEND = cache.HTTPBackend(url)
+"""
+import hmac
+import os
+import re
+import shutil
+import uuid
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Iterable
+from urllib.parse import unquote
+
+from cache import TOKEN_ENV
+
+# Addresses allowed to upload when the server has no token
+DEFAULT_ALLOW = ('127.0.0.1', '::1')
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles GET, HEAD and PUT of /blobs/<sha256> and /refs/<name>.
+    The root directory, token and allowed addresses are given
+    by the server (see CacheServer).
+    """
+
+    def _path(self):
+        """
+        :return: local path of requested blob or ref (None if invalid)
+        """
+        match = re.fullmatch(r'/(blobs)/([0-9a-f]{64})|/(refs)/([^/]+)', self.path)
+        if match is None:
+            return None
+        if match.group(1):
+            return os.path.join(self.server.root, 'blobs', match.group(2))
+        name = unquote(match.group(4))
+        if '/' in name or '\\' in name or name.startswith('.'):
+            return None
+        return os.path.join(self.server.root, 'refs', name)
+
+    def _authorized(self) -> bool:
+        """
+        :return: whether the client may upload, i.e. it sent the token,
+                 or the server has none and the client address is allowed
+        """
+        if self.server.token is not None:
+            return hmac.compare_digest(self.headers.get('Authorization', ''),
+                                       f"Bearer {self.server.token}")
+        return self.client_address[0] in self.server.allow
+
+    def _send_file(self, with_body: bool) -> None:
+        path = self._path()
+        if path is None:
+            self.send_error(400)
+            return
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        if with_body:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+
+    def do_GET(self) -> None:
+        self._send_file(with_body=True)
+
+    def do_HEAD(self) -> None:
+        self._send_file(with_body=False)
+
+    def do_PUT(self) -> None:
+        if not self._authorized():
+            self.send_error(403)
+            return
+        path = self._path()
+        length = self.headers.get('Content-Length')
+        if path is None or length is None:
+            self.send_error(400)
+            return
+
+        # Stream the body into temporary file, then rename it into place
+        tmp_path = os.path.join(self.server.root, f".tmp-{uuid.uuid4().hex}")
+        m = sha256()
+        remaining = int(length)
+        try:
+            with open(tmp_path, 'wb') as f:
+                while remaining > 0:
+                    block = self.rfile.read(min(remaining, 1 << 20))
+                    if not block:
+                        break
+                    remaining -= len(block)
+                    m.update(block)
+                    f.write(block)
+            is_blob = os.path.basename(os.path.dirname(path)) == 'blobs'
+            if remaining > 0 or (is_blob and m.hexdigest() != os.path.basename(path)):
+                self.send_error(400, "Incomplete or corrupt content")
+                return
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class CacheServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server storing the entries in root directory.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, root: str, token: str = None,
+                 allow: Iterable[str] = DEFAULT_ALLOW):
+        """
+        :param address: (host, port) to listen on
+        :param root: directory with stored blobs and refs
+        :param token: shared secret required for uploads (None for no token)
+        :param allow: addresses allowed to upload when there is no token
+        """
+        self.root = root
+        self.token = token
+        self.allow = frozenset(allow)
+        os.makedirs(os.path.join(root, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'refs'), exist_ok=True)
+        super().__init__(address, CacheRequestHandler)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Shared cache server")
+    parser.add_argument('--root', default='../cache_shared',
+                        help="directory with stored entries")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="address to listen on (0.0.0.0 for all interfaces)")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--token', default=os.environ.get(TOKEN_ENV),
+                        help=f"shared secret required for uploads "
+                             f"(default from {TOKEN_ENV})")
+    parser.add_argument('--allow', nargs='*', default=list(DEFAULT_ALLOW),
+                        help="addresses allowed to upload without token")
+    arguments = parser.parse_args()
+
+    if arguments.token is None and arguments.host not in DEFAULT_ALLOW:
+        print(f"Warning: no token, uploads accepted from {', '.join(arguments.allow)}")
+    server = CacheServer((arguments.host, arguments.port), arguments.root,
+                         arguments.token, arguments.allow)
+    print(f"Serving {arguments.root} on {arguments.host}:{arguments.port}")
+    server.serve_forever()
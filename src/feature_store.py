@@ -0,0 +1,287 @@
+"""
+In this file, we define an on-disk store of computed feature matrices,
+shared by the scripts and the notebook. Each feature set is identified
+by its extractor (name, parameters and code version), the fingerprint
+of the dataset of images and the split, and it is stored in
+<STORE_DIR>/<name>/<split>-<key>/ as .npy blocks in the project precision
+(memory-mapped when read) with the index of the image of each row.
+Processes extending the same feature set take turns through the lock
+file <split>-<key>.lock next to it.
+
+Usage: train_X = feature_store.load_features('gray_hog', train_x, 'train')
+"""
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+from typing import Dict
+
+import cache
+from precision import float_dtype
+from transformers import HogTransformer, HueTransformer
+
+STORE_DIR = "../features"
+# Changes whenever the layout of stored feature sets changes
+STORE_VERSION = 1
+META_NAME = "meta.json"
+# Float type of feature sets stored before it was kept in metadata
+DEFAULT_DTYPE = 'float32'
+# Number of images extracted and appended at once by materialize
+CHUNK_SIZE = 5000
+
+# Feature extractors shared by KNN.py, baseline.py and the notebook
+EXTRACTORS = {
+    'gray_hog': lambda: HogTransformer(cells_per_block=(2, 2), n_jobs=-1),
+    'rgb_hog': lambda: HogTransformer(cells_per_block=(2, 2), color='rgb',
+                                      scale=False, n_jobs=-1),
+    'hue': lambda: HueTransformer(),
+}
+# Parameters of extractors, which do not change the features
+_IGNORED_PARAMS = ('n_jobs', 'chunk_size')
+
+
+class FeatureSet:
+    """
+    Feature matrix stored in blocks of rows, each with the indices
+    of images (in the dataset) of its rows.
+    """
+
+    def __init__(self, path: str, description: Dict):
+        """
+        Opens stored feature set, or prepares empty one (created on disk
+        with the first append) of features in the project precision.
+
+        :param path: directory of the feature set
+        :param description: extractor, params, dataset and split
+                            (stored in metadata)
+        """
+        self.path = path
+        self.description = description
+        self.refresh()
+
+    def refresh(self) -> None:
+        """
+        Reads the metadata again (other process may have changed it).
+        """
+        meta_path = os.path.join(self.path, META_NAME)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = dict(self.description, version=STORE_VERSION, n_features=None,
+                             dtype=float_dtype().name, blocks=[])
+
+    def lock(self) -> cache._FileLock:
+        """
+        :return: lock of the feature set shared by processes, to be held
+                 while it is extended or compacted
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return cache._FileLock(self.path + ".lock")
+
+    def _write_meta(self) -> None:
+        # Write to temporary file and rename it, so readers see whole metadata
+        tmp_path = os.path.join(self.path, f".{META_NAME}.{uuid.uuid4().hex}")
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(tmp_path, os.path.join(self.path, META_NAME))
+
+    def __len__(self) -> int:
+        return sum(block['rows'] for block in self.meta['blocks'])
+
+    @property
+    def n_features(self) -> int:
+        return self.meta['n_features']
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(self.meta.get('dtype', DEFAULT_DTYPE))
+
+    @property
+    def image_index(self) -> np.ndarray:
+        """
+        :return: index of image of each row
+        """
+        if not self.meta['blocks']:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.load(os.path.join(self.path, block['index']))
+                               for block in self.meta['blocks']])
+
+    def append(self, features: np.ndarray, image_index: np.ndarray) -> None:
+        """
+        Appends rows as a new block.
+
+        :param features: array of shape [n, n_features]
+        :param image_index: index of image of each row, shape [n]
+        """
+        if len(features) != len(image_index):
+            raise ValueError("Expected one image index for each row")
+        if self.n_features is not None and features.shape[1] != self.n_features:
+            raise ValueError(f"Expected {self.n_features} features, got {features.shape[1]}")
+        os.makedirs(self.path, exist_ok=True)
+        block_id = uuid.uuid4().hex[:12]
+        block = {'features': f"block-{block_id}.npy", 'index': f"index-{block_id}.npy",
+                 'rows': len(features)}
+        np.save(os.path.join(self.path, block['features']),
+                np.asarray(features, dtype=self.dtype))
+        np.save(os.path.join(self.path, block['index']),
+                np.asarray(image_index, dtype=np.int64))
+        self.meta['n_features'] = int(features.shape[1])
+        self.meta['blocks'].append(block)
+        self._write_meta()
+
+    def read(self, rows: slice = slice(None)) -> np.ndarray:
+        """
+        :param rows: slice of rows
+        :return: features of the rows (memory-mapped, if stored in one block)
+        """
+        paths = [os.path.join(self.path, block['features']) for block in self.meta['blocks']]
+        blocks = [np.load(path, mmap_mode='r') for path in paths]
+        if len(blocks) == 1:
+            features = blocks[0][rows]
+            if rows == slice(None):
+                # Cached functions then hash the file instead of the content
+                cache.tag_source(features, paths[0])
+            return features
+        if not blocks:
+            return np.empty((0, self.n_features or 0), dtype=self.dtype)[rows]
+        # Not compacted (see compact), read into memory
+        return np.concatenate(blocks)[rows]
+
+    def take(self, image_indices: np.ndarray) -> np.ndarray:
+        """
+        :param image_indices: indices of images in the dataset
+        :return: features of given images (in the given order)
+        """
+        image_index = self.image_index
+        rows = np.full(image_index.max(initial=-1) + 1, -1, dtype=np.int64)
+        rows[image_index] = np.arange(len(image_index))
+        image_indices = np.asarray(image_indices)
+        if np.any(image_indices >= len(rows)) or np.any(rows[image_indices] < 0):
+            raise KeyError("Features of some of the images are not stored")
+        return self.read()[rows[image_indices]]
+
+    def compact(self) -> None:
+        """
+        Merges all blocks into one (so read returns memory-mapped array).
+        Removes the merged blocks, so hold the lock (see lock).
+        """
+        if len(self.meta['blocks']) <= 1:
+            return
+        block_id = uuid.uuid4().hex[:12]
+        block = {'features': f"block-{block_id}.npy", 'index': f"index-{block_id}.npy",
+                 'rows': len(self)}
+        out = np.lib.format.open_memmap(os.path.join(self.path, block['features']),
+                                        mode='w+', dtype=self.dtype,
+                                        shape=(len(self), self.n_features))
+        offset = 0
+        for old in self.meta['blocks']:
+            rows = np.load(os.path.join(self.path, old['features']), mmap_mode='r')
+            out[offset:offset + len(rows)] = rows
+            offset += len(rows)
+        out.flush()
+        del out
+        np.save(os.path.join(self.path, block['index']), self.image_index)
+
+        old_blocks = self.meta['blocks']
+        self.meta['blocks'] = [block]
+        self._write_meta()
+        for old in old_blocks:
+            for key in ('features', 'index'):
+                os.remove(os.path.join(self.path, old[key]))
+
+
+def _extractor_params(extractor) -> Dict:
+    """
+    :param extractor: transformer (with get_params and transform)
+    :return: its parameters which determine the features
+    """
+    return {key: value for key, value in extractor.get_params().items()
+            if key not in _IGNORED_PARAMS}
+
+
+def feature_set(name: str, params: Dict, dataset: str, split: str,
+                version: str = "", root: str = None) -> FeatureSet:
+    """
+    :param name: name of the extractor
+    :param params: parameters of the extractor
+    :param dataset: fingerprint of the dataset of images
+    :param split: name of the split, e.g. 'train' or 'test'
+    :param version: version of the extractor code
+    :param root: directory of the store (default STORE_DIR)
+    :return: the (possibly empty) feature set for these keys
+    """
+    description = {
+        'extractor': name,
+        'params': json.loads(json.dumps(params, default=str)),
+        'dataset': dataset,
+        'split': split,
+        'code': version,
+    }
+    key = cache.content_hash((description, STORE_VERSION))[:16]
+    path = os.path.join(root or STORE_DIR, name, f"{split}-{key}")
+    return FeatureSet(path, description)
+
+
+def materialize(name: str, extractor, images: np.ndarray, split: str,
+                chunk_size: int = CHUNK_SIZE, root: str = None) -> FeatureSet:
+    """
+    Returns stored features of images, extracting (chunk by chunk)
+    and appending those which are not stored yet, so interrupted
+    extraction continues where it stopped. Features are stored in the
+    project precision (part of the key). Concurrent calls for the same
+    feature set wait for each other.
+
+    :param name: name of the extractor
+    :param extractor: transformer computing features of images
+    :param images: CIFAR-images in default format
+    :param split: name of the split, e.g. 'train' or 'test'
+    :param chunk_size: number of images extracted and appended at once
+    :param root: directory of the store (default STORE_DIR)
+    :return: complete feature set of images
+    """
+    params = _extractor_params(extractor)
+    params['precision'] = float_dtype().name
+    features = feature_set(
+        name, params, cache.content_hash(images), split,
+        cache.content_hash(type(extractor).transform), root
+    )
+    with features.lock():
+        # Rows appended by other process while waiting are not extracted again
+        features.refresh()
+        missing = np.setdiff1d(np.arange(len(images)), features.image_index)
+        for start in range(0, len(missing), chunk_size):
+            indices = missing[start:start + chunk_size]
+            features.append(extractor.transform(images[indices]), indices)
+        features.compact()
+    return features
+
+
+def load_features(name: str, images: np.ndarray, split: str,
+                  root: str = None) -> np.ndarray:
+    """
+    Features of images by one of the shared EXTRACTORS,
+    extracted only if they are not stored yet.
+
+    :param name: key of EXTRACTORS
+    :param images: CIFAR-images in default format
+    :param split: name of the split, e.g. 'train' or 'test'
+    :param root: directory of the store (default STORE_DIR)
+    :return: memory-mapped array of shape [n, n_features] in the
+             project precision
+             (rows in order of images)
+    """
+    features = materialize(name, EXTRACTORS[name](), images, split, root=root)
+    if np.array_equal(features.image_index, np.arange(len(images))):
+        return features.read()
+    return features.take(np.arange(len(images)))
+
+
+def clear_store(root: str = None) -> None:
+    """
+    Removes all stored feature sets.
+
+    :param root: directory of the store (default STORE_DIR)
+    """
+    shutil.rmtree(root or STORE_DIR, ignore_errors=True)
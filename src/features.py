@@ -0,0 +1,328 @@
+"""
+In this file, we define feature extraction computed on whole batches
+of images at once with numpy array operations, instead of calling
+scikit-image functions image by image.
+
+batch_hog() reproduces skimage.feature.hog (with transform_sqrt=False
+and feature_vector=True), including its binning of orientations and
+its handling of cells, for batches of images of shape [n, rows, cols]
+or [n, rows, cols, channels].
+
+batch_rgb_to_hsv() and batch_hue() reproduce skimage.color.rgb2hsv
+(the latter only its hue channel, without computing saturation and value)
+for batches of rgb images, including uint8 images (e.g. output of
+batch_to_rgb) which are converted to floats only chunk by chunk.
+
+LazyFeatures represents feature matrix of images without computing it,
+its rows are extracted only when sliced, so it can be streamed
+chunk by chunk (e.g. to reduction.fit_reducer and Reducer.transform).
+"""
+import numpy as np
+from typing import Callable, Tuple
+from precision import float_dtype
+
+
+def _normalize_blocks(blocks: np.ndarray, method: str,
+                      eps: float = 1e-5) -> np.ndarray:
+    """
+    Normalizes blocks as skimage.feature._hog._hog_normalize_block does,
+    but for all blocks at once.
+
+    :param blocks: array of shape [..., b_row, b_col, orientations]
+    :param method: 'L1', 'L1-sqrt', 'L2' or 'L2-Hys'
+    :param eps: constant avoiding division by zero
+    :return: normalized blocks (new array)
+    """
+    axes = (-3, -2, -1)
+    if method == 'L1':
+        return blocks / (np.sum(np.abs(blocks), axis=axes, keepdims=True) + eps)
+    if method == 'L1-sqrt':
+        return np.sqrt(
+            blocks / (np.sum(np.abs(blocks), axis=axes, keepdims=True) + eps)
+        )
+    if method == 'L2':
+        return blocks / np.sqrt(
+            np.sum(blocks ** 2, axis=axes, keepdims=True) + eps ** 2
+        )
+    if method == 'L2-Hys':
+        out = blocks / np.sqrt(
+            np.sum(blocks ** 2, axis=axes, keepdims=True) + eps ** 2
+        )
+        out = np.minimum(out, 0.2)
+        return out / np.sqrt(np.sum(out ** 2, axis=axes, keepdims=True) + eps ** 2)
+    raise ValueError('Selected block normalization method is invalid.')
+
+
+def _gradients(images: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Central differences along rows and columns (zero on the border),
+    as skimage.feature._hog._hog_channel_gradient.
+
+    :param images: array of shape [n, rows, cols, ...]
+    :return: (gradient along rows, gradient along columns)
+    """
+    g_row = np.zeros_like(images)
+    g_row[:, 1:-1] = images[:, 2:] - images[:, :-2]
+    g_col = np.zeros_like(images)
+    g_col[:, :, 1:-1] = images[:, :, 2:] - images[:, :, :-2]
+    return g_row, g_col
+
+
+def _cell_histograms(g_row: np.ndarray, g_col: np.ndarray, orientations: int,
+                     pixels_per_cell: Tuple[int, int]) -> np.ndarray:
+    """
+    Histograms of oriented gradients in cells, as
+    skimage.feature._hoghistogram.hog_histograms, but for whole batch.
+    Like there, magnitudes are accumulated in float32 pixel by pixel
+    (in row-major order within cell), so the results are equal.
+
+    Note: as in skimage, cell k along an axis covers pixels
+    (k * cell + cell // 2) + [-(cell // 2), (cell + 1) // 2), which
+    for odd sizes of cells leaves out the last pixel of the cell.
+
+    :param g_row: gradients along rows, shape [n, rows, cols]
+    :param g_col: gradients along columns, shape [n, rows, cols]
+    :param orientations: number of orientation bins
+    :param pixels_per_cell: size (in pixels) of a cell
+    :return: array of shape [n, n_cells_row, n_cells_col, orientations]
+    """
+    n, s_row, s_col = g_row.shape
+    c_row, c_col = pixels_per_cell
+    n_cells_row, n_cells_col = s_row // c_row, s_col // c_col
+
+    magnitude = np.hypot(g_col, g_row)
+    orientation = np.rad2deg(np.arctan2(g_row, g_col)) % 180
+
+    # Bin i holds orientations in [180 / o * i, 180 / o * (i + 1))
+    per_bin = np.float32(180. / orientations)
+    edges = (per_bin * np.arange(orientations + 1, dtype=np.float32)).astype(float)
+    bins = np.searchsorted(edges, orientation, side='right') - 1
+    one_hot = np.arange(orientations)
+
+    hist = np.zeros((n, n_cells_row, n_cells_col, orientations), dtype=np.float32)
+    cell_rows = c_row * np.arange(n_cells_row) + c_row // 2
+    cell_cols = c_col * np.arange(n_cells_col) + c_col // 2
+    for d_row in range(-(c_row // 2), (c_row + 1) // 2):
+        for d_col in range(-(c_col // 2), (c_col + 1) // 2):
+            # Pixel at this position of every cell
+            index = np.ix_(np.arange(n), cell_rows + d_row, cell_cols + d_col)
+            in_bin = bins[index][..., None] == one_hot
+            hist = (hist + np.where(in_bin, magnitude[index][..., None], 0.)) \
+                .astype(np.float32)
+    return (hist / np.float32(c_row * c_col)).astype(float)
+
+
+def _hog_chunk(images: np.ndarray, orientations: int,
+               pixels_per_cell: Tuple[int, int], cells_per_block: Tuple[int, int],
+               block_norm: str, multichannel: bool, dtype) -> np.ndarray:
+    """
+    HOG descriptors of a chunk of images (see batch_hog).
+    """
+    images = images.astype(dtype, copy=False)
+    g_row, g_col = _gradients(images)
+    if multichannel:
+        # Take gradient of the channel with the largest magnitude
+        idcs_max = np.hypot(g_row, g_col).argmax(axis=-1)[..., None]
+        g_row = np.take_along_axis(g_row, idcs_max, axis=-1)[..., 0]
+        g_col = np.take_along_axis(g_col, idcs_max, axis=-1)[..., 0]
+
+    hist = _cell_histograms(g_row, g_col, orientations, pixels_per_cell) \
+        .astype(dtype, copy=False)
+
+    # Sliding window view of blocks: [n, blocks_row, blocks_col, b_row, b_col, o]
+    n, n_cells_row, n_cells_col, _ = hist.shape
+    b_row, b_col = cells_per_block
+    n_blocks_row = n_cells_row - b_row + 1
+    n_blocks_col = n_cells_col - b_col + 1
+    s = hist.strides
+    blocks = np.lib.stride_tricks.as_strided(
+        hist,
+        shape=(n, n_blocks_row, n_blocks_col, b_row, b_col, orientations),
+        strides=(s[0], s[1], s[2], s[1], s[2], s[3]),
+        writeable=False
+    )
+    normalized = _normalize_blocks(blocks, block_norm)
+    return normalized.reshape((n, -1)).astype(dtype, copy=False)
+
+
+def _hog_length(image_shape: Tuple[int, int], orientations: int,
+                pixels_per_cell: Tuple[int, int],
+                cells_per_block: Tuple[int, int]) -> int:
+    """
+    :param image_shape: (rows, cols) of the images
+    :return: length of HOG descriptor of such image (see batch_hog)
+    """
+    n_blocks = [size // cell - block + 1 for size, cell, block
+                in zip(image_shape, pixels_per_cell, cells_per_block)]
+    return max(0, n_blocks[0]) * max(0, n_blocks[1]) \
+        * cells_per_block[0] * cells_per_block[1] * orientations
+
+
+def batch_hog(images: np.ndarray, orientations: int = 9,
+              pixels_per_cell: Tuple[int, int] = (8, 8),
+              cells_per_block: Tuple[int, int] = (3, 3),
+              block_norm: str = 'L2-Hys', multichannel: bool = False,
+              chunk_size: int = 1000, dtype=None) -> np.ndarray:
+    """
+    Computes HOG descriptors of whole batch of images, the same as calling
+    skimage.feature.hog(img, orientations, pixels_per_cell, cells_per_block,
+    block_norm, multichannel=multichannel) for each img, but with array
+    operations on chunks of images. Defaults are the same as in skimage.
+
+    :param images: images of shape [n, rows, cols] or (with multichannel)
+                   [n, rows, cols, channels], e.g. output of scale_to_rgb
+    :param orientations: number of orientation bins
+    :param pixels_per_cell: size (in pixels) of a cell
+    :param cells_per_block: number of cells in each block
+    :param block_norm: 'L1', 'L1-sqrt', 'L2' or 'L2-Hys'
+    :param multichannel: whether the last axis holds color channels
+    :param chunk_size: number of images processed at once
+    :param dtype: float type of the computation and of the result
+                  (default the project precision, see precision.py)
+    :return: array of shape [n, n_features] with descriptor of each image
+    """
+    dtype = float_dtype(dtype)
+    images = np.asarray(images)
+    if images.ndim != (4 if multichannel else 3):
+        raise ValueError(f"Expected batch of {'multichannel' if multichannel else '2D'} "
+                         f"images, got shape {images.shape}")
+
+    n_features = _hog_length(images.shape[1:3], orientations,
+                             pixels_per_cell, cells_per_block)
+    out = np.empty((images.shape[0], n_features), dtype=dtype)
+    for start in range(0, images.shape[0], chunk_size):
+        out[start:start + chunk_size] = _hog_chunk(
+            images[start:start + chunk_size], orientations,
+            tuple(pixels_per_cell), tuple(cells_per_block),
+            block_norm, multichannel, dtype
+        )
+    return out
+
+
+def _hue_chunk(rgb: np.ndarray, v: np.ndarray, delta: np.ndarray) -> np.ndarray:
+    """
+    Hue of float rgb images as in skimage.color.rgb2hsv: if more channels
+    are maximal, blue wins over green and green over red; grays have hue 0.
+
+    :param rgb: float array of shape [..., 3]
+    :param v: maximum over channels, shape [...]
+    :param delta: maximum minus minimum over channels, shape [...]
+    :return: hue in range 0-1, shape [...]
+    """
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    blue_max = b == v
+    green_max = ~blue_max & (g == v)
+    numerator = np.where(blue_max, r - g, np.where(green_max, b - r, g - b))
+    offset = np.where(blue_max, 4, np.where(green_max, 2, 0)).astype(rgb.dtype)
+    gray = delta == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hue = (offset + numerator / delta) / 6 % 1
+    hue[gray] = 0
+    return hue
+
+
+def _rgb_chunks(images: np.ndarray, dtype, chunk_size: int):
+    """
+    Yields (start, chunk) with chunks of rgb images converted to floats
+    of given dtype, uint8 images are also scaled to range 0-1.
+
+    :param images: rgb images of shape [n, rows, cols, 3]
+    :param dtype: float type of the chunks
+    :param chunk_size: number of images in each chunk
+    """
+    images = np.asarray(images)
+    if images.ndim != 4 or images.shape[-1] != 3:
+        raise ValueError(f"Expected batch of rgb images, got shape {images.shape}")
+    for start in range(0, images.shape[0], chunk_size):
+        chunk = images[start:start + chunk_size].astype(dtype)
+        if images.dtype == np.uint8:
+            chunk /= 255
+        yield start, chunk
+
+
+def batch_rgb_to_hsv(images: np.ndarray, dtype=None,
+                     chunk_size: int = 5000) -> np.ndarray:
+    """
+    Converts batch of rgb images to HSV, the same as calling
+    skimage.color.rgb2hsv for each image, but with array operations
+    on chunks of images.
+
+    :param images: rgb images of shape [n, rows, cols, 3], either uint8
+                   (e.g. batch_to_rgb) or floats in range 0-1
+    :param dtype: float type of the computation and of the result
+                  (default the project precision, see precision.py)
+    :param chunk_size: number of images converted at once
+    :return: images in HSV, shape [n, rows, cols, 3]
+    """
+    dtype = float_dtype(dtype)
+    out = np.empty(np.shape(images), dtype=dtype)
+    for start, chunk in _rgb_chunks(images, dtype, chunk_size):
+        hsv = out[start:start + chunk_size]
+        v = chunk.max(axis=-1)
+        delta = v - chunk.min(axis=-1)
+        hsv[..., 0] = _hue_chunk(chunk, v, delta)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            hsv[..., 1] = np.where(delta == 0, 0, delta / v)
+        hsv[..., 2] = v
+    return out
+
+
+def batch_hue(images: np.ndarray, dtype=None,
+              chunk_size: int = 5000) -> np.ndarray:
+    """
+    Computes only hue channel of batch_rgb_to_hsv (same as
+    rgb2hsv(img)[:, :, 0] for each img).
+
+    :param images: rgb images of shape [n, rows, cols, 3], either uint8
+                   (e.g. batch_to_rgb) or floats in range 0-1
+    :param dtype: float type of the computation and of the result
+                  (default the project precision, see precision.py)
+    :param chunk_size: number of images converted at once
+    :return: hue of images, shape [n, rows, cols]
+    """
+    dtype = float_dtype(dtype)
+    out = np.empty(np.shape(images)[:-1], dtype=dtype)
+    for start, chunk in _rgb_chunks(images, dtype, chunk_size):
+        v = chunk.max(axis=-1)
+        out[start:start + chunk_size] = _hue_chunk(chunk, v, v - chunk.min(axis=-1))
+    return out
+
+
+class LazyFeatures:
+    """
+    Feature matrix of images, whose rows are computed only when sliced:
+    rows [a:b] are extract(images[a:b], **params). Converts to full
+    array (np.asarray) only when needed as a whole.
+    """
+
+    def __init__(self, images: np.ndarray, extract: Callable, **params):
+        """
+        :param images: batch of images (first axis indexes images)
+        :param extract: function computing features of batch of images,
+                        returning array of shape [n, n_features]
+        :param params: keyword arguments of extract
+        """
+        self.images = images
+        self.extract = extract
+        self.params = params
+        sample = extract(images[:1], **params)
+        self.shape = (len(images), sample.shape[1])
+        self.dtype = sample.dtype
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, rows: slice) -> np.ndarray:
+        """
+        :param rows: slice of rows
+        :return: features of the sliced images
+        """
+        if not isinstance(rows, slice):
+            raise TypeError("LazyFeatures can be indexed only by slice of rows")
+        return self.extract(self.images[rows], **self.params)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        out = np.empty(self.shape, dtype=self.dtype)
+        for start in range(0, len(self), 1000):
+            out[start:start + 1000] = self[start:start + 1000]
+        return out if dtype is None else out.astype(dtype, copy=False)
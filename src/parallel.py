@@ -0,0 +1,191 @@
+"""
+In this file, we define parallel feature extraction over processes,
+which share the input images through multiprocessing.shared_memory
+(Python 3.8+) and the output matrix through a memory-mapped file in
+SHARED_DIR. Workers receive only ranges of indices and write features
+of their images in place, so neither images nor features are pickled
+between processes. The file is removed once the workers finish, and
+the returned array keeps its mapping, so the features are not copied.
+The worker processes are kept alive between calls (see _executor).
+
+Usage: parallel_extract(batch_hog, gray_images, n_jobs=-3, cells_per_block=(2, 2))
+"""
+import os
+import threading
+from contextlib import contextmanager
+import numpy as np
+from typing import Callable
+
+# Images in one task of a worker
+CHUNK_SIZE = 1000
+# Directory of the shared output (tmpfs if available, so it stays in memory)
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Process pool reused by parallel_extract (see _executor)
+_EXECUTOR = {}
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def _n_workers(n_jobs: int) -> int:
+    """
+    :param n_jobs: number of processes, negative as in joblib
+                   (-1 all cpus, -2 all but one, ...)
+    :return: number of worker processes
+    """
+    if n_jobs < 0:
+        return max(1, os.cpu_count() + 1 + n_jobs)
+    return max(1, n_jobs)
+
+
+def _attach(name: str):
+    """
+    Attaches existing shared memory without registering it in the
+    resource tracker of this process (it is owned by the parent).
+
+    :param name: name of the shared memory block
+    :return: SharedMemory
+    """
+    from multiprocessing import shared_memory, resource_tracker
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always registers attached blocks, skip it (the
+        # tracker may be shared with the parent, which unregisters it)
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _work(extract: Callable, params: dict, src: tuple, dst: str,
+          start: int, stop: int) -> None:
+    """
+    Extracts features of images [start, stop) into shared output
+    (in worker process, which attaches the shared arrays for the task).
+
+    :param extract: function computing features of batch of images
+    :param params: keyword arguments of extract
+    :param src: (name, shape, dtype) of shared images
+    :param dst: path of the .npy file of features
+    :param start: first image of the task
+    :param stop: end of the images of the task
+    """
+    name, shape, dtype = src
+    shm = _attach(name)
+    try:
+        images = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        out = np.load(dst, mmap_mode='r+')
+        out[start:stop] = extract(images[start:stop], **params)
+        del images, out
+    finally:
+        shm.close()
+
+
+@contextmanager
+def _executor(n_workers: int):
+    """
+    Process pool of n_workers, kept alive between calls, as starting the
+    processes costs more than extracting a chunk of images (e.g. when
+    feature_store.materialize extracts chunk by chunk). Calls use it one
+    at a time, each of them uses all the workers anyway.
+
+    :param n_workers: number of worker processes
+    :return: context manager giving ProcessPoolExecutor
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    with _EXECUTOR_LOCK:
+        executor = _EXECUTOR.get('executor')
+        if executor is None or _EXECUTOR['n_workers'] != n_workers:
+            if executor is not None:
+                executor.shutdown()
+            executor = ProcessPoolExecutor(n_workers)
+            _EXECUTOR.update(executor=executor, n_workers=n_workers)
+        try:
+            yield executor
+        except BrokenProcessPool:
+            # A worker died, start new pool next time
+            _EXECUTOR.clear()
+            executor.shutdown(wait=False)
+            raise
+
+
+def _shared_array(shape: tuple, dtype):
+    """
+    :return: (SharedMemory, np.ndarray using its buffer)
+    """
+    from multiprocessing import shared_memory
+
+    size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _shared_output(shape: tuple, dtype):
+    """
+    :return: (path of .npy file in SHARED_DIR, writable memmap of the file)
+    """
+    import tempfile
+
+    fd, path = tempfile.mkstemp(suffix='.npy', prefix='features-', dir=SHARED_DIR)
+    os.close(fd)
+    try:
+        return path, np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    except BaseException:
+        os.remove(path)
+        raise
+
+
+def parallel_extract(extract: Callable, images: np.ndarray, n_jobs: int = -1,
+                     chunk_size: int = CHUNK_SIZE, **params) -> np.ndarray:
+    """
+    Computes extract(images, **params) in parallel processes, each
+    processing chunks of images from shared memory and writing the
+    features into preallocated shared output. The processes are
+    reused by following calls with the same n_jobs.
+
+    :param extract: module-level function (picklable by reference) computing
+                    features of batch of images, returning array [n, n_features]
+                    (e.g. features.batch_hog)
+    :param images: batch of images (first axis indexes images)
+    :param n_jobs: number of processes, negative as in joblib
+    :param chunk_size: number of images in one task
+    :param params: keyword arguments of extract
+    :return: array of shape [n, n_features] ([0, n_features] for no images)
+    """
+    images = np.asarray(images)
+    n = images.shape[0]
+    # Shape and dtype of the features, from a blank image if there are none
+    probe = images[:1] if n else np.zeros((1,) + images.shape[1:], dtype=images.dtype)
+    sample = extract(probe, **params)
+    n_workers = _n_workers(n_jobs)
+    if min(n_workers, -(-n // chunk_size)) <= 1:
+        out = np.empty((n, sample.shape[1]), dtype=sample.dtype)
+        for start in range(0, n, chunk_size):
+            out[start:start + chunk_size] = extract(images[start:start + chunk_size], **params)
+        return out
+
+    src_shm, src = _shared_array(images.shape, images.dtype)
+    try:
+        dst_path, dst = _shared_output((n, sample.shape[1]), sample.dtype)
+        try:
+            src[...] = images
+            src_info = (src_shm.name, src.shape, src.dtype.str)
+            with _executor(n_workers) as executor:
+                tasks = [executor.submit(_work, extract, params, src_info, dst_path,
+                                         start, min(start + chunk_size, n))
+                         for start in range(0, n, chunk_size)]
+                for task in tasks:
+                    task.result()
+        finally:
+            # The mapping outlives the file (POSIX), until the result is freed
+            os.remove(dst_path)
+    finally:
+        del src
+        src_shm.close()
+        src_shm.unlink()
+    return dst.view(np.ndarray)
@@ -0,0 +1,147 @@
+"""
+In this file, we define the floating point precision used through
+the project: scaled images, HOG and hue features, PCA components and
+reduced features. float32 halves the memory traffic and the size of
+cached results, compare_precision reports how the accuracy moves
+compared to float64.
+
+Usage: precision.set_precision(np.float64) before pre-processing,
+or temporarily: with precision.use_precision(np.float64): ...
+"""
+import threading
+from contextlib import contextmanager
+import numpy as np
+import cache
+
+# Float type of images, features and PCA
+FLOAT_DTYPE = np.float32
+PRECISIONS = (np.float32, np.float64)
+# Precision of background computations of cache, overriding FLOAT_DTYPE
+# in their thread (see _thread_precision)
+_THREAD = threading.local()
+
+
+def _current() -> type:
+    """
+    :return: precision of the current thread
+    """
+    return getattr(_THREAD, 'dtype', None) or FLOAT_DTYPE
+
+
+def float_dtype(dtype=None) -> np.dtype:
+    """
+    :param dtype: explicitly requested float type (or None)
+    :return: dtype if given, else the project precision
+    """
+    return np.dtype(_current() if dtype is None else dtype)
+
+
+def set_precision(dtype) -> None:
+    """
+    Sets the project precision.
+
+    :param dtype: np.float32 or np.float64
+    """
+    global FLOAT_DTYPE
+    if np.dtype(dtype) not in PRECISIONS:
+        raise ValueError(f"Unsupported precision {dtype}, expected one of {PRECISIONS}")
+    FLOAT_DTYPE = np.dtype(dtype).type
+
+
+@contextmanager
+def use_precision(dtype):
+    """
+    Sets the project precision inside with block.
+
+    :param dtype: np.float32 or np.float64
+    """
+    previous = FLOAT_DTYPE
+    set_precision(dtype)
+    try:
+        yield
+    finally:
+        set_precision(previous)
+
+
+def _cache_context() -> str:
+    # Cached results differ by precision
+    return np.dtype(_current()).name
+
+
+@contextmanager
+def _thread_precision(name: str):
+    """
+    Sets precision of the current thread only, to the one captured
+    when background computation was submitted (see cache.prefetch).
+
+    :param name: name of the dtype (as returned by _cache_context)
+    """
+    previous = getattr(_THREAD, 'dtype', None)
+    _THREAD.dtype = np.dtype(name).type
+    try:
+        yield
+    finally:
+        _THREAD.dtype = previous
+
+
+cache.add_key_context(_cache_context, _thread_precision)
+
+
+def compare_precision(preprocess, model, train_x, train_y, test_x, test_y) -> dict:
+    """
+    Runs the pre-processing and fits the model on its result with float64
+    and float32 precision, and reports the accuracy on test data.
+
+    :param preprocess: function (train_x, train_y, test_x, test_y) ->
+                       (train_X, train_y, test_X, test_y, ...),
+                       e.g. preprocessing.hog_preprocessing
+    :param model: sklearn classifier (fitted clones are used)
+    :param train_x: train data
+    :param train_y: train labels
+    :param test_x: test data
+    :param test_y: test labels
+    :return: dict with accuracy, bytes of features and their dtype
+             for each precision, change of accuracy (float32 - float64)
+             and ratio of equal predictions
+    """
+    from sklearn.base import clone
+    from sklearn.metrics import accuracy_score
+
+    results = {}
+    predictions = {}
+    for dtype in (np.float64, np.float32):
+        with use_precision(dtype):
+            prep_train_x, prep_train_y, prep_test_x, prep_test_y = \
+                preprocess(train_x, train_y, test_x, test_y)[:4]
+            name = np.dtype(dtype).name
+            predictions[name] = clone(model).fit(prep_train_x, prep_train_y) \
+                .predict(prep_test_x)
+            results[name] = {
+                'accuracy': accuracy_score(prep_test_y, predictions[name]),
+                'nbytes': prep_train_x.nbytes + prep_test_x.nbytes,
+                'dtype': str(prep_train_x.dtype),
+            }
+    results['accuracy_change'] = \
+        results['float32']['accuracy'] - results['float64']['accuracy']
+    results['agreement'] = float(np.mean(predictions['float32'] == predictions['float64']))
+    return results
+
+
+if __name__ == '__main__':
+    from sklearn.neighbors import KNeighborsClassifier
+    from sklearn.utils import resample
+    import preprocessing
+    import utils
+
+    train_x, train_y = utils.read_dataset()
+    test_x, test_y = utils.read_test_batch()
+    train_x, train_y = resample(train_x, train_y, replace=False, n_samples=10000,
+                                random_state=42, stratify=train_y)
+    test_x, test_y = test_x[:2000], test_y[:2000]
+
+    knn = KNeighborsClassifier(n_neighbors=10, p=1, weights='distance', n_jobs=-1)
+    for prep in (preprocessing.hsv_preprocessing, preprocessing.hog_preprocessing):
+        print(prep.__name__)
+        for key, value in compare_precision(prep, knn, train_x, train_y,
+                                            test_x, test_y).items():
+            print(f"  {key}: {value}")
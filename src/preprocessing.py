@@ -10,6 +10,8 @@ from skimage.feature import hog
 from skimage import filters
 import matplotlib.pyplot as plt
 from cache import cache
+from features import batch_rgb_to_hsv
+from precision import float_dtype
 
 
 def batch_to_rgb(images: np.ndarray) -> np.ndarray:
@@ -27,6 +29,31 @@ def batch_to_rgb(images: np.ndarray) -> np.ndarray:
     return images.reshape((-1, 3, 32, 32)).transpose(0, 2, 3, 1)
 
 
+def scale_to_rgb(images: np.ndarray, dtype=None,
+                 chunk_size: int = 5000) -> np.ndarray:
+    """
+    Converts CIFAR-images to rgb (see batch_to_rgb) and scales the values
+    to range 0-1. The images are processed in chunks, written (and scaled
+    in-place) into preallocated C-contiguous output of the given dtype,
+    so the only large array allocated is the result itself.
+
+    :param images: CIFAR-images in default format
+    :param dtype: float type of the result (default the project precision)
+    :param chunk_size: number of images converted at once
+    :return: C-contiguous scaled images of shape [?, 32, 32, 3]
+    """
+    dtype = float_dtype(dtype)
+    if len(images.shape) == 1:
+        return scale_to_rgb(images.reshape((1, -1)), dtype, chunk_size)[0]
+
+    out = np.empty((images.shape[0], 32, 32, 3), dtype=dtype)
+    for start in range(0, images.shape[0], chunk_size):
+        chunk = out[start:start + chunk_size]
+        chunk[...] = batch_to_rgb(images[start:start + chunk_size])
+        chunk /= 255
+    return out
+
+
 def rgb_to_gray(images: np.ndarray) -> np.ndarray:
     """
     Converts rgb images to gray scale.
@@ -44,7 +71,9 @@ def rgb_to_hsv(images: np.ndarray) -> np.ndarray:
     :return: array of images in HSV, each with shape [?, .., .., 3]
     """
     if len(images.shape) == 4:
-        return np.array(list(map(rgb2hsv, images)))
+        return batch_rgb_to_hsv(
+            images, dtype=images.dtype if images.dtype.kind == 'f' else float_dtype()
+        )
     return rgb2hsv(images)
 
 
@@ -63,23 +92,23 @@ def brightness_norm(images: np.ndarray) -> np.ndarray:
                      where=maxes_stack != 0)
 
 
-def rgb_scale(train_x, test_x):
+def rgb_scale(train_x, test_x, dtype=None):
     """
-    Converts to rgb, scales to 0-1
+    Converts to rgb, scales to 0-1 (see scale_to_rgb)
 
     :param train_x: train data
     :param test_x: test data
+    :param dtype: float type of the result (default the project precision)
     :return: train_X, test_X
     """
-    train_x = batch_to_rgb(train_x)
-    test_x = batch_to_rgb(test_x)
-    train_x = train_x / 255.0
-    test_x = test_x / 255.0
+    train_x = scale_to_rgb(train_x, dtype)
+    test_x = scale_to_rgb(test_x, dtype)
     return train_x, test_x
 
 
 @cache
-def hog_preprocessing(train_x, train_y, test_x, test_y):
+def hog_preprocessing(train_x, train_y, test_x, test_y, reducer='full', variance=0.95,
+                      n_components=None):
     """
     Pre-processes data to HOGS, computes PCA
 
@@ -87,44 +116,28 @@ def hog_preprocessing(train_x, train_y, test_x, test_y):
     :param train_y: train_labels
     :param test_x: test_data
     :param test_y: test_labels
-    :return: train_X, train_y, test_X, test_y, PCA
-    """
-    from joblib import Parallel, delayed
-    from skimage.feature import hog
-    from sklearn.decomposition import PCA
-
-    train_x, test_x = rgb_scale(train_x, test_x)
-
-    def h(pic):
-        return hog(
-            pic,
-            orientations=8,
-            pixels_per_cell=(2, 2),
-            cells_per_block=(2, 2),
-            visualize=False,
-            multichannel=True
-        )
-
-    train_x = np.asarray(
-        Parallel(n_jobs=-3, verbose=4, batch_size=1000)(delayed(h)(x) for x in train_x)
-    )
-    test_x = np.asarray(
-        Parallel(n_jobs=-3, verbose=4, batch_size=500)(delayed(h)(x) for x in test_x)
-    )
-
-    pca = PCA(
-        n_components=0.95,  # keep at least 95% of variance
-        svd_solver='full',  # given by previous
-        copy=True,  # apply the same transform to test set as well
-    ).fit(train_x)
+    :param reducer: 'full', 'randomized' or 'incremental' PCA (see reduction)
+    :param variance: ratio of variance kept by PCA
+    :param n_components: initial number of components of incremental PCA
+                         (see reduction.fit_reducer)
+    :return: train_X, train_y, test_X, test_y, fitted pipeline (for new images)
+    """
+    from sklearn.pipeline import make_pipeline
+    from transformers import CenteredPCA, HogTransformer
 
-    train_x = pca.transform(train_x)
-    test_x = pca.transform(test_x)
-    return train_x, train_y, test_x, test_y, pca
+    hog = HogTransformer(orientations=8, pixels_per_cell=(2, 2),
+                         cells_per_block=(2, 2), color='rgb')
+    # HOGs are computed chunk by chunk when PCA needs them, with
+    # 'incremental' reducer the whole HOG matrix is never held in memory
+    pca = CenteredPCA(reducer, variance, n_components)
+    train_x = pca.fit_transform(hog.transform_lazy(train_x))
+    test_x = pca.transform(hog.transform_lazy(test_x))
+    return train_x, train_y, test_x, test_y, make_pipeline(hog, pca)
 
 
-@cache
-def hsv_preprocessing(train_x, train_y, test_x, test_y):
+@cache(codec='auto')
+def hsv_preprocessing(train_x, train_y, test_x, test_y, reducer='full', variance=0.95,
+                      n_components=None):
     """
     Converts to rgv, hsv, keeps h, runs pca
 
@@ -132,32 +145,19 @@ def hsv_preprocessing(train_x, train_y, test_x, test_y):
     :param train_y: train_labels
     :param test_x: test_data
     :param test_y: test_labels
-    :return: train_X, train_y, test_X, test_y, PCA
+    :param reducer: 'full', 'randomized' or 'incremental' PCA (see reduction)
+    :param variance: ratio of variance kept by PCA
+    :param n_components: initial number of components of incremental PCA
+                         (see reduction.fit_reducer)
+    :return: train_X, train_y, test_X, test_y, fitted pipeline (for new images)
     """
-    from skimage.color import rgb2hsv
-    from sklearn.decomposition import PCA
-
-    train_x, test_x = rgb_scale(train_x, test_x)
-    train_x = rgb_to_hsv(train_x)[:, :, :, 0]
-    test_x = rgb_to_hsv(test_x)[:, :, :, 0]
-
-    # flatten
-    train_x = train_x.reshape((train_x.shape[0], -1))
-    test_x = test_x.reshape((test_x.shape[0], -1))
-
-    mean_image = np.mean(train_x, axis=0)
-    train_x -= mean_image
-    test_x -= mean_image
-
-    pca = PCA(
-        n_components=0.95,  # keep at least 95% of variance
-        svd_solver='full',  # given by previous
-        copy=True,  # apply the same transform to test set as well
-    ).fit(train_x)
+    from sklearn.pipeline import make_pipeline
+    from transformers import CenteredPCA, HueTransformer
 
-    train_x = pca.transform(train_x)
-    test_data = pca.transform(test_x)
-    return train_x, train_y, test_x, test_y, pca
+    hsv = make_pipeline(HueTransformer(), CenteredPCA(reducer, variance, n_components))
+    train_x = hsv.fit_transform(train_x)
+    test_x = hsv.transform(test_x)
+    return train_x, train_y, test_x, test_y, hsv
 
 
 def demo(X: np.ndarray, ax: np.ndarray) -> None:
@@ -238,7 +238,7 @@ if __name__ == "__main__":
     ax = axes.ravel()
 
     # !NORMALISE to range <0, 1>
-    X = batch_to_rgb(X) / 255.0
+    X = scale_to_rgb(X)
     demo(X, ax[:3*4])
 
     print("\nAnd now after brightness normalization\n")
@@ -0,0 +1,286 @@
+"""
+In this file, we define the dimensionality reduction (PCA) used in the
+pre-processing stages. The reducer is selectable:
+
+- 'full': exact PCA (LAPACK SVD of the whole matrix),
+- 'randomized': randomized SVD, with rank doubled until the components
+  explain the required variance,
+- 'incremental': IncrementalPCA fed by chunks of rows, with components
+  doubled until they explain the required variance.
+
+The data may be given as features.LazyFeatures; the incremental reducer
+then streams its chunks, so the feature matrix is never held in memory
+(features are extracted again in the second pass, in transform). The
+other reducers need the whole matrix, so fit_transform computes it
+once and uses it for both fit and transform.
+
+Fitted reducer keeps its explained-variance curve, so it can transform
+with any variance threshold up to the one it was fitted for, without
+refitting. Fitted reducers are cached on disk (see fit_transform).
+"""
+import warnings
+import numpy as np
+from cache import cache
+from precision import float_dtype
+
+REDUCERS = ('full', 'randomized', 'incremental')
+# Variance explained by the fitted (and cached) reducers at least,
+# lower thresholds are then taken from the same reducer
+FIT_VARIANCE = 0.95
+# First rank tried by the randomized reducer
+RANDOMIZED_START_RANK = 64
+# Rows in a chunk of the incremental reducer (and of transform)
+CHUNK_SIZE = 2000
+
+
+class Reducer:
+    """
+    Fitted linear projection to principal components, with
+    the explained-variance curve of the fitted components.
+    """
+
+    def __init__(self, method: str, mean: np.ndarray, components: np.ndarray,
+                 explained_variance: np.ndarray, explained_variance_ratio: np.ndarray,
+                 variance: float):
+        """
+        :param method: reducer which fitted the components (see REDUCERS)
+        :param mean: mean of the training rows
+        :param components: principal axes, shape [n_components, n_features]
+        :param explained_variance: variance explained by each component
+        :param explained_variance_ratio: ratio of total variance explained
+                                         by each component
+        :param variance: default variance threshold of transform
+        """
+        self.method = method
+        self.mean_ = mean
+        self.components_ = components
+        self.explained_variance_ = explained_variance
+        self.explained_variance_ratio_ = explained_variance_ratio
+        self.variance = variance
+
+    @property
+    def variance_curve(self) -> np.ndarray:
+        """
+        :return: cumulative ratio of variance explained by first k components
+        """
+        return np.cumsum(self.explained_variance_ratio_)
+
+    @property
+    def n_components_(self) -> int:
+        """
+        :return: number of components used with the default threshold
+        """
+        return self.n_components_for(self.variance)
+
+    def n_components_for(self, variance: float) -> int:
+        """
+        Number of components explaining at least given ratio of variance
+        (the same rule as in sklearn PCA with n_components in (0, 1)).
+
+        :param variance: ratio of variance in range (0, 1]
+        :return: number of components
+        """
+        curve = self.variance_curve
+        k = min(int(np.searchsorted(curve, variance, side='right')) + 1, len(curve))
+        # Complete curve (of all components) reaches 1 up to rounding
+        if k > len(self.components_) or (curve[k - 1] < variance
+                                         and not np.isclose(curve[-1], 1)):
+            raise ValueError(f"Reducer was fitted only for "
+                             f"{curve[len(self.components_) - 1]:.4f} of variance, "
+                             f"fit it again for threshold {variance}")
+        return k
+
+    def transform(self, x: np.ndarray, variance: float = None,
+                  chunk_size: int = CHUNK_SIZE, out: np.ndarray = None) -> np.ndarray:
+        """
+        Projects rows of x to the components (as sklearn PCA.transform),
+        chunk by chunk into preallocated output. x may also be
+        features.LazyFeatures, whose rows are then computed chunk by chunk.
+
+        :param x: array of shape [n, n_features]
+        :param variance: variance threshold (default the one given in fit)
+        :param chunk_size: number of rows projected at once
+        :param out: output array of shape [n, n_components], e.g. memmap
+                    (see open_output), default newly allocated array
+        :return: array of shape [n, n_components] (out, if given)
+        """
+        k = self.n_components_for(self.variance if variance is None else variance)
+        components = self.components_[:k]
+        if out is None:
+            out = np.empty((x.shape[0], k), dtype=components.dtype)
+        elif out.shape != (x.shape[0], k):
+            raise ValueError(f"Expected output of shape {(x.shape[0], k)}, got {out.shape}")
+        for start in range(0, x.shape[0], chunk_size):
+            chunk = x[start:start + chunk_size] - self.mean_
+            out[start:start + chunk_size] = chunk.dot(components.T)
+        return out
+
+    def with_variance(self, variance: float) -> 'Reducer':
+        """
+        :param variance: new default variance threshold
+        :return: the same fitted reducer (sharing arrays) with new threshold
+        """
+        self.n_components_for(variance)
+        return Reducer(self.method, self.mean_, self.components_, self.explained_variance_,
+                       self.explained_variance_ratio_, variance)
+
+
+def open_output(path: str, reducer: Reducer, n_rows: int,
+                variance: float = None) -> np.ndarray:
+    """
+    Creates memory-mapped .npy file for output of reducer.transform,
+    so the reduced data need not fit into memory.
+
+    :param path: path of the .npy file
+    :param reducer: fitted reducer
+    :param n_rows: number of transformed rows
+    :param variance: variance threshold of transform
+    :return: writable memmap of shape [n_rows, n_components]
+    """
+    k = reducer.n_components_for(reducer.variance if variance is None else variance)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=reducer.components_.dtype,
+                                     shape=(n_rows, k))
+
+
+def _from_pca(pca, method: str, variance: float) -> Reducer:
+    """
+    :param pca: fitted sklearn PCA or IncrementalPCA
+    :param method: name of the reducer
+    :param variance: default variance threshold
+    :return: Reducer with all components of pca (in the project precision)
+    """
+    dtype = float_dtype()
+    return Reducer(method, pca.mean_.astype(dtype, copy=False),
+                   pca.components_.astype(dtype, copy=False),
+                   pca.explained_variance_, pca.explained_variance_ratio_, variance)
+
+
+def _fit_full(x: np.ndarray, variance: float) -> Reducer:
+    from sklearn.decomposition import PCA
+
+    pca = PCA(svd_solver='full').fit(x)
+    reducer = _from_pca(pca, 'full', variance)
+    # Keep only components needed for the threshold, but the whole curve
+    k = reducer.n_components_for(variance)
+    reducer.components_ = reducer.components_[:k].copy()
+    return reducer
+
+
+def _fit_randomized(x: np.ndarray, variance: float, random_state: int) -> Reducer:
+    from sklearn.decomposition import PCA
+
+    max_rank = min(x.shape) - 1
+    rank = min(RANDOMIZED_START_RANK, max_rank)
+    while True:
+        pca = PCA(n_components=rank, svd_solver='randomized',
+                  random_state=random_state).fit(x)
+        if pca.explained_variance_ratio_.sum() >= variance:
+            return _from_pca(pca, 'randomized', variance)
+        if rank >= max_rank:
+            # Variance cannot be reached by randomized SVD
+            return _fit_full(x, variance)
+        rank = min(2 * rank, max_rank)
+
+
+def _fit_incremental(x: np.ndarray, variance: float, n_components: int,
+                     chunk_size: int) -> Reducer:
+    # Uses only shape and slices of rows of x, which may be LazyFeatures
+    from sklearn.decomposition import IncrementalPCA
+    from sklearn.utils import gen_batches
+
+    max_components = min(x.shape)
+    if n_components is None:
+        n_components = min(x.shape[1], chunk_size)
+    n_components = min(n_components, max_components)
+    while True:
+        pca = IncrementalPCA(n_components=n_components)
+        # Each batch must have at least n_components rows
+        batch_size = max(chunk_size, n_components)
+        for batch in gen_batches(x.shape[0], batch_size, min_batch_size=n_components):
+            pca.partial_fit(x[batch])
+        reducer = _from_pca(pca, 'incremental', variance)
+        if reducer.variance_curve[-1] >= variance or n_components >= max_components:
+            break
+        # Fit again with more components (another pass over x)
+        warnings.warn(f"{n_components} components explain only "
+                      f"{reducer.variance_curve[-1]:.4f} of variance, "
+                      f"fitting {min(2 * n_components, max_components)}")
+        n_components = min(2 * n_components, max_components)
+
+    # Raises (so nothing is cached) if even all components fall short
+    reducer.n_components_for(variance)
+    return reducer
+
+
+def fit_reducer(x: np.ndarray, method: str = 'full', variance: float = FIT_VARIANCE,
+                n_components: int = None, chunk_size: int = CHUNK_SIZE,
+                random_state: int = 42) -> Reducer:
+    """
+    Fits selected reducer to rows of x, keeping components
+    which explain at least given ratio of variance.
+
+    :param x: training data of shape [n, n_features] (or LazyFeatures)
+    :param method: one of REDUCERS
+    :param variance: ratio of variance to keep, in range (0, 1]
+    :param n_components: initial number of components of incremental reducer
+                         (default min(n_features, chunk_size)), doubled
+                         until they explain the variance
+    :param chunk_size: number of rows in a chunk of incremental reducer
+    :param random_state: seed of randomized reducer
+    :return: fitted Reducer
+    """
+    if method != 'incremental':
+        # Other reducers need the whole matrix (also of LazyFeatures)
+        x = np.asarray(x)
+    if method == 'full':
+        return _fit_full(x, variance)
+    if method == 'randomized':
+        return _fit_randomized(x, variance, random_state)
+    if method == 'incremental':
+        return _fit_incremental(x, variance, n_components, chunk_size)
+    raise ValueError(f"Unknown reducer {method!r}, expected one of {REDUCERS}")
+
+
+@cache(codec='auto')
+def _fit_reducer_cached(x: np.ndarray, method: str, variance: float,
+                        n_components: int = None) -> Reducer:
+    return fit_reducer(x, method, variance, n_components)
+
+
+def cached_fit_reducer(x: np.ndarray, method: str = 'full',
+                       variance: float = 0.95, n_components: int = None) -> Reducer:
+    """
+    Fits reducer (see fit_reducer) or loads it from cache. The reducer
+    is fitted for at least FIT_VARIANCE of variance, so thresholds
+    up to it reuse the same fitted reducer.
+
+    :param x: training data of shape [n, n_features] (or LazyFeatures)
+    :param method: one of REDUCERS
+    :param variance: ratio of variance to keep
+    :param n_components: initial number of components of incremental reducer
+                         (see fit_reducer)
+    :return: fitted Reducer with given default threshold
+    """
+    reducer = _fit_reducer_cached(x, method, max(variance, FIT_VARIANCE), n_components)
+    return reducer.with_variance(variance)
+
+
+def fit_transform(train_x: np.ndarray, test_x: np.ndarray, method: str = 'full',
+                  variance: float = 0.95):
+    """
+    Fits reducer on train data (or loads it from cache, see
+    cached_fit_reducer) and reduces both train and test data.
+    Only the incremental reducer streams LazyFeatures of train data
+    (computing them twice), for the others the train matrix is
+    computed once and used for both fit and transform.
+
+    :param train_x: train data of shape [n, n_features] (or LazyFeatures)
+    :param test_x: test data of shape [m, n_features] (or LazyFeatures)
+    :param method: one of REDUCERS
+    :param variance: ratio of variance to keep
+    :return: train_X, test_X, Reducer
+    """
+    if method != 'incremental':
+        train_x = np.asarray(train_x)
+    reducer = cached_fit_reducer(train_x, method, variance)
+    return reducer.transform(train_x), reducer.transform(test_x), reducer
@@ -0,0 +1,207 @@
+"""
+In this file, we define the pre-processing steps as scikit-learn
+transformers with separate fit and transform, so the steps fitted
+on train data transform new images later by the same code, e.g.
+
+    features = make_pipeline(HogTransformer(color='rgb'), CenteredPCA())
+    train_X = features.fit_transform(train_x)
+    new_X = features.transform(new_x)
+
+HogTransformer and HueTransformer take CIFAR-images in default format
+(rows of 3072 values) and are stateless, CenteredPCA keeps only
+the mean, the used components and the explained-variance curve.
+"""
+import numpy as np
+from typing import Tuple
+from sklearn.base import BaseEstimator, TransformerMixin
+from skimage.color import rgb2gray
+
+import reduction
+from features import LazyFeatures, batch_hog, batch_hue
+from parallel import parallel_extract
+from precision import float_dtype
+from preprocessing import batch_to_rgb, scale_to_rgb
+
+
+def _hog_of_images(images: np.ndarray, color: str, scale: bool, dtype,
+                   **params) -> np.ndarray:
+    """
+    HOG descriptors of CIFAR-images (module-level function, so it
+    can be sent to worker processes, see parallel_extract).
+
+    :param images: CIFAR-images in default format
+    :param color: 'gray' (HOG of grayscale) or 'rgb' (HOG of color images)
+    :param scale: whether to scale rgb values to range 0-1
+    :param dtype: float type of the computation and of the result
+    :param params: parameters of batch_hog
+    :return: array of shape [?, n_features]
+    """
+    if color == 'gray':
+        return batch_hog(rgb2gray(batch_to_rgb(images)), dtype=dtype, **params)
+    rgb = scale_to_rgb(images, dtype) if scale else batch_to_rgb(images)
+    return batch_hog(rgb, multichannel=True, dtype=dtype, **params)
+
+
+class HogTransformer(BaseEstimator, TransformerMixin):
+    """
+    Transforms CIFAR-images to HOG descriptors (see features.batch_hog).
+    """
+
+    def __init__(self, orientations: int = 9, pixels_per_cell: Tuple[int, int] = (8, 8),
+                 cells_per_block: Tuple[int, int] = (3, 3), block_norm: str = 'L2-Hys',
+                 color: str = 'gray', scale: bool = True, dtype=None,
+                 chunk_size: int = 1000, n_jobs: int = 1):
+        """
+        :param orientations: number of orientation bins
+        :param pixels_per_cell: size (in pixels) of a cell
+        :param cells_per_block: number of cells in each block
+        :param block_norm: 'L1', 'L1-sqrt', 'L2' or 'L2-Hys'
+        :param color: 'gray' (HOG of grayscale) or 'rgb' (HOG of color images)
+        :param scale: whether to scale rgb values to range 0-1
+        :param dtype: float type of the result (default the project precision)
+        :param chunk_size: number of images processed at once
+        :param n_jobs: number of processes (see parallel_extract)
+        """
+        self.orientations = orientations
+        self.pixels_per_cell = pixels_per_cell
+        self.cells_per_block = cells_per_block
+        self.block_norm = block_norm
+        self.color = color
+        self.scale = scale
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+
+    def _params(self) -> dict:
+        # Precision is resolved here, as worker processes do not share it
+        return dict(color=self.color, scale=self.scale, dtype=float_dtype(self.dtype),
+                    orientations=self.orientations,
+                    pixels_per_cell=tuple(self.pixels_per_cell),
+                    cells_per_block=tuple(self.cells_per_block),
+                    block_norm=self.block_norm)
+
+    def fit(self, x, y=None) -> 'HogTransformer':
+        """
+        Nothing to fit, HOG has no state.
+        """
+        return self
+
+    def transform(self, x: np.ndarray) -> np.ndarray:
+        """
+        :param x: CIFAR-images in default format
+        :return: array of shape [?, n_features]
+        """
+        return parallel_extract(_hog_of_images, x, n_jobs=self.n_jobs,
+                                chunk_size=self.chunk_size, **self._params())
+
+    def transform_lazy(self, x: np.ndarray) -> LazyFeatures:
+        """
+        :param x: CIFAR-images in default format
+        :return: HOG descriptors computed only when sliced (see LazyFeatures)
+        """
+        return LazyFeatures(x, _hog_of_images, **self._params())
+
+
+class HueTransformer(BaseEstimator, TransformerMixin):
+    """
+    Transforms CIFAR-images to flattened hue channel of HSV
+    (see features.batch_hue).
+    """
+
+    def __init__(self, dtype=None, chunk_size: int = 5000):
+        """
+        :param dtype: float type of the result (default the project precision)
+        :param chunk_size: number of images converted at once
+        """
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+
+    def fit(self, x, y=None) -> 'HueTransformer':
+        """
+        Nothing to fit, conversion to HSV has no state.
+        """
+        return self
+
+    def transform(self, x: np.ndarray) -> np.ndarray:
+        """
+        :param x: CIFAR-images in default format
+        :return: array of shape [?, 32 * 32]
+        """
+        hue = batch_hue(batch_to_rgb(x), self.dtype, self.chunk_size)
+        return hue.reshape((hue.shape[0], -1))
+
+
+class CenteredPCA(BaseEstimator, TransformerMixin):
+    """
+    Centers data by mean of train data and projects it to principal
+    components explaining given ratio of variance (see reduction).
+    Fitted reducers are cached (see reduction.cached_fit_reducer).
+    """
+
+    def __init__(self, reducer: str = 'full', variance: float = 0.95,
+                 n_components: int = None, chunk_size: int = reduction.CHUNK_SIZE):
+        """
+        :param reducer: 'full', 'randomized' or 'incremental' PCA
+        :param variance: ratio of variance to keep
+        :param n_components: initial number of components of incremental PCA
+                             (see reduction.fit_reducer)
+        :param chunk_size: number of rows projected at once
+        """
+        self.reducer = reducer
+        self.variance = variance
+        self.n_components = n_components
+        self.chunk_size = chunk_size
+
+    def fit(self, x: np.ndarray, y=None) -> 'CenteredPCA':
+        """
+        Reducers other than 'incremental' compute whole LazyFeatures
+        here, use fit_transform to project the same matrix.
+
+        :param x: train data of shape [n, n_features] (or LazyFeatures)
+        :return: self
+        """
+        reducer = reduction.cached_fit_reducer(x, self.reducer, self.variance,
+                                               self.n_components)
+        # Keep only the used components
+        k = reducer.n_components_
+        self.reducer_ = reduction.Reducer(
+            reducer.method, reducer.mean_, reducer.components_[:k].copy(),
+            reducer.explained_variance_, reducer.explained_variance_ratio_, self.variance
+        )
+        return self
+
+    def transform(self, x: np.ndarray) -> np.ndarray:
+        """
+        :param x: data of shape [n, n_features] (or LazyFeatures)
+        :return: array of shape [n, n_components_]
+        """
+        return self.reducer_.transform(x, chunk_size=self.chunk_size)
+
+    def fit_transform(self, x: np.ndarray, y=None) -> np.ndarray:
+        """
+        Fits to x and projects it. Only the incremental reducer streams
+        LazyFeatures (computed again in transform), the others need
+        the whole matrix, so it is computed once for both.
+
+        :param x: train data of shape [n, n_features] (or LazyFeatures)
+        :return: array of shape [n, n_components_]
+        """
+        if self.reducer != 'incremental':
+            x = np.asarray(x)
+        return self.fit(x).transform(x)
+
+    @property
+    def mean_(self) -> np.ndarray:
+        return self.reducer_.mean_
+
+    @property
+    def components_(self) -> np.ndarray:
+        return self.reducer_.components_
+
+    @property
+    def explained_variance_ratio_(self) -> np.ndarray:
+        return self.reducer_.explained_variance_ratio_[:self.n_components_]
+
+    @property
+    def n_components_(self) -> int:
+        return self.reducer_.n_components_
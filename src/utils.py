@@ -19,15 +19,34 @@ a Python dictionary object. It has the following entries:
 * label_names -- a 10-element list which gives meaningful names to the numeric
   labels in the labels array described above. For example,
   label_names[0] == "airplane", label_names[1] == "automobile", etc.
+
+Since unpickling the batches is slow, the data can also be converted once
+into a flat binary format (see convert_dataset()), which is then opened
+as np.memmap by read_dataset(mmap=True) and read_test_batch(mmap=True).
+Such file starts with a header of BINARY_HEADER_SIZE bytes (magic string,
+format version, number of images and size of one image), followed by
+the raw uint8 images and then by one uint8 label per image.
 """
+import os
+import struct
 import numpy as np
-from typing import Dict, Any, Tuple, List
+from typing import Dict, Any, Tuple, List, Iterator
 import cache
 
 
 # Default path to un-tarred image data
 CIFAR_PATH = '../dataset'
 
+# Names of files in the flat binary format (stored next to the batches)
+BINARY_TRAIN_FILE = '/data_batch.bin'
+BINARY_TEST_FILE = '/test_batch.bin'
+
+# Header of the binary format: magic, version, image count, image size
+BINARY_MAGIC = b'CIFAR10B'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<8sIII')
+BINARY_HEADER_SIZE = 64
+
 
 def unpickle(path: str) -> Dict:
     """
@@ -89,34 +108,211 @@ def read_data_batch(i: int, path: str = CIFAR_PATH) -> Tuple[Any, np.ndarray]:
     return batch[b'data'], np.array(batch[b'labels'])
 
 
-def read_dataset(path: str = CIFAR_PATH) -> Tuple[Any, np.ndarray]:
+def write_binary(filename: str, imgs: np.ndarray, labels: np.ndarray) -> None:
+    """
+    Writes images and labels to file in the flat binary format. The file
+    is written under temporary name and then renamed, so that processes
+    reading the dataset never see partially written file.
+
+    :param filename: path of the resulting file
+    :param imgs: uint8 images of shape [n, 3072]
+    :param labels: integer labels [0-9] of the images
+    """
+    imgs = np.ascontiguousarray(imgs, dtype=np.uint8)
+    labels = np.ascontiguousarray(labels, dtype=np.uint8)
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION,
+                                imgs.shape[0], imgs.shape[1])
+    tmp_name = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_name, 'wb') as f:
+        f.write(header.ljust(BINARY_HEADER_SIZE, b'\0'))
+        f.write(imgs.tobytes())
+        f.write(labels.tobytes())
+    os.replace(tmp_name, filename)
+
+
+def read_binary(filename: str) -> Tuple[np.memmap, np.memmap]:
+    """
+    Opens file in the flat binary format as read-only memory maps.
+    Nothing is read until the data are accessed, and the pages are
+    shared (through the OS page cache) by all processes opening the file.
+
+    :param filename: path of file written by write_binary()
+    :return: tuple (imgs, labels) of np.memmaps (note: uint8 labels)
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(BINARY_HEADER.size)
+    if len(header) < BINARY_HEADER.size:
+        raise ValueError(f"{filename} is not a CIFAR binary file")
+    magic, version, count, size = BINARY_HEADER.unpack(header)
+    if magic != BINARY_MAGIC:
+        raise ValueError(f"{filename} is not a CIFAR binary file")
+    if version != BINARY_VERSION:
+        raise ValueError(f"{filename} has unsupported version {version}")
+
+    imgs = np.memmap(filename, dtype=np.uint8, mode='r',
+                     offset=BINARY_HEADER_SIZE, shape=(count, size))
+    labels = np.memmap(filename, dtype=np.uint8, mode='r',
+                       offset=BINARY_HEADER_SIZE + count * size,
+                       shape=(count,))
+
+    # Let cache keys use the file instead of hashing the whole content
+    cache.tag_source(imgs, filename, 'imgs')
+    cache.tag_source(labels, filename, 'labels')
+    return imgs, labels
+
+
+def convert_dataset(path: str = CIFAR_PATH) -> None:
+    """
+    One-time conversion of all data-batch files and the test batch
+    to the flat binary format, stored in the same folder.
+
+    :param path: path to folder with batch files
+    """
+    imgs, labels = read_dataset(path)
+    write_binary(path + BINARY_TRAIN_FILE, imgs, labels)
+    del imgs, labels
+
+    batch = load_test_batch(path)
+    write_binary(path + BINARY_TEST_FILE,
+                 batch[b'data'], np.array(batch[b'labels']))
+
+
+def _load_batch_into(filename: str, imgs: np.ndarray,
+                     labels: np.ndarray) -> None:
+    """
+    Decodes batch file and copies its content into (preallocated) arrays.
+
+    :param filename: path of the batch file
+    :param imgs: slice of output array for images of this batch
+    :param labels: slice of output array for labels of this batch
+    """
+    batch = unpickle(filename)
+    if len(batch[b'labels']) != labels.shape[0]:
+        raise ValueError(f"{filename} does not contain "
+                         f"{labels.shape[0]} images")
+    imgs[:] = batch[b'data']
+    labels[:] = batch[b'labels']
+
+
+def read_dataset(path: str = CIFAR_PATH, mmap: bool = False,
+                 n_jobs: int = 1) -> Tuple[Any, np.ndarray]:
     """
-    Load and process (concatenate) all data-batch files.
+    Load and process (concatenate) all data-batch files. Each file is
+    decoded and copied straight into its part of a single preallocated
+    array, so besides the result only n_jobs decoded batches are held
+    in memory at a time.
 
     :param path: path to folder with file
-    :return: tuple (imgs, labels) of np.arrays (note: integer labels)
+    :param mmap: return read-only np.memmaps of the binary format
+                 instead (converts the dataset first, if needed)
+    :param n_jobs: number of threads decoding the batch files (unpickling
+                   holds the GIL, more threads only help on slow disks)
+    :return: tuple (imgs, labels) of np.arrays (note: uint8 labels)
     """
-    all_images, all_labels = [], []
-    for i in range(1, 6):
-        imgs, labels = read_data_batch(i)
-        all_images.append(imgs)
-        all_labels.append(labels)
-    all_images = np.concatenate(all_images, axis=0)
-    all_labels = np.concatenate(all_labels, axis=0)
+    from concurrent.futures import ThreadPoolExecutor
+
+    if mmap:
+        if not os.path.exists(path + BINARY_TRAIN_FILE):
+            convert_dataset(path)
+        return read_binary(path + BINARY_TRAIN_FILE)
+
+    files = _batch_files(path, train=True, test=False)
+    per_batch = load_meta(path)[b'num_cases_per_batch']
+    all_images = np.empty((len(files) * per_batch, 3072), dtype=np.uint8)
+    all_labels = np.empty(len(files) * per_batch, dtype=np.uint8)
+    parts = [(filename,
+              all_images[i * per_batch:(i + 1) * per_batch],
+              all_labels[i * per_batch:(i + 1) * per_batch])
+             for i, filename in enumerate(files)]
+
+    if n_jobs <= 1:
+        for part in parts:
+            _load_batch_into(*part)
+        return all_images, all_labels
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        jobs = [executor.submit(_load_batch_into, *part) for part in parts]
+        for job in jobs:
+            # Propagate possible exception from the worker
+            job.result()
     return all_images, all_labels
 
 
-def read_test_batch(path: str = CIFAR_PATH) -> Tuple[Any, np.ndarray]:
+def read_test_batch(path: str = CIFAR_PATH,
+                    mmap: bool = False) -> Tuple[Any, np.ndarray]:
     """
     Load and process test file.
 
     :param path: path to folder with file
+    :param mmap: return read-only np.memmaps of the binary format
+                 instead (converts the dataset first, if needed)
     :return: tuple (imgs, labels) of np.arrays (note: integer labels)
     """
+    if mmap:
+        if not os.path.exists(path + BINARY_TEST_FILE):
+            convert_dataset(path)
+        return read_binary(path + BINARY_TEST_FILE)
     batch = load_test_batch(path)
     return batch[b'data'], np.array(batch[b'labels'])
 
 
+def _batch_files(path: str, train: bool, test: bool) -> List[str]:
+    """
+    :param path: path to folder with batch files
+    :param train: whether to include the data-batch files
+    :param test: whether to include the test batch
+    :return: paths of the batch files in the canonical order
+    """
+    files = []
+    if train:
+        files += [path + '/data_batch_' + str(i) for i in range(1, 6)]
+    if test:
+        files.append(path + '/test_batch')
+    return files
+
+
+def iter_dataset(chunk_size: int = 1000, path: str = CIFAR_PATH,
+                 train: bool = True, test: bool = True
+                 ) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Iterates over the batch files in chunks of (at most) chunk_size images,
+    so that only one batch file and one chunk are held in memory at a time.
+    Chunks span the boundaries of batch files, only the last one can be
+    smaller. Global indices number the images across all iterated files,
+    i.e. the train images come first (0-49999) and the test ones follow.
+
+    :param chunk_size: number of images in one chunk
+    :param path: path to folder with batch files
+    :param train: whether to iterate over the data-batch files
+    :param test: whether to iterate over the test batch
+    :return: generator of tuples (imgs, labels, global_indices)
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+
+    rest_imgs, rest_labels = None, None
+    start = 0
+    for filename in _batch_files(path, train, test):
+        batch = unpickle(filename)
+        imgs, labels = batch[b'data'], np.array(batch[b'labels'])
+        del batch
+        if rest_imgs is not None:
+            # Complete the chunk left over from the previous file
+            imgs = np.concatenate((rest_imgs, imgs), axis=0)
+            labels = np.concatenate((rest_labels, labels), axis=0)
+
+        full = imgs.shape[0] - imgs.shape[0] % chunk_size
+        for i in range(0, full, chunk_size):
+            yield (imgs[i:i + chunk_size], labels[i:i + chunk_size],
+                   np.arange(start, start + chunk_size))
+            start += chunk_size
+        rest_imgs, rest_labels = imgs[full:], labels[full:]
+
+    if rest_imgs is not None and rest_imgs.shape[0] > 0:
+        yield (rest_imgs, rest_labels,
+               np.arange(start, start + rest_imgs.shape[0]))
+
+
 def read_meta(path: str = CIFAR_PATH) -> np.ndarray:
     """
     Loads and returns CIFAR10 label names in order, i.e.
@@ -133,9 +329,10 @@ def get_label_name(label: int) -> str:
     :param label: integer image label
     :return: corresponding string label name
     """
-    return read_meta()[label].decode('utf-8')
+    return get_all_labels()[label]
 
 
+@cache.cache_on_the_fly
 def get_all_labels(path: str = CIFAR_PATH) -> List[str]:
     """
     Reads the labels, decodes and returns as an array
@@ -155,3 +352,81 @@ def imgs_of_cat(batch: Dict, category: int) -> np.ndarray:
     :return: np.array of all images of specific category (e.i. label) 
     """
     return batch[b'data'][np.array(batch[b'labels']) == category]
+
+
+class CifarDataset:
+    """
+    Images with labels loaded once, together with precomputed index
+    of images of each category. The index is stored in CSR style:
+    images of category c are at positions order[offsets[c]:offsets[c + 1]]
+    of the data and there are counts[c] of them.
+
+    The images and labels are kept as given (imgs[i] is still the caller's
+    i-th image). Besides them, the images are copied once into category
+    order (sorted_imgs), so images and positions of one category are
+    obtained in O(1) as views, without scanning the labels or copying.
+    """
+
+    def __init__(self, imgs: np.ndarray, labels: np.ndarray,
+                 path: str = CIFAR_PATH):
+        """
+        :param imgs: images in format as in batch (1D arrays [R, G, B])
+        :param labels: integer labels of the images
+        :param path: path to folder with meta data (for label names)
+        """
+        self.imgs = np.asarray(imgs)
+        self.labels = np.asarray(labels)
+        self.label_names = get_all_labels(path)
+        # Stable, so that the original order within category is preserved
+        self.order = np.argsort(self.labels, kind='stable')
+        self.counts = np.bincount(self.labels, minlength=len(self.label_names))
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+        # Images of category c are sorted_imgs[offsets[c]:offsets[c + 1]]
+        self.sorted_imgs = self.imgs[self.order]
+        self.sorted_imgs.flags.writeable = False
+
+    @classmethod
+    def from_batch(cls, batch: Dict, path: str = CIFAR_PATH) -> 'CifarDataset':
+        """
+        :param batch: dictionary with images and labels (see global docs)
+        :param path: path to folder with meta data
+        :return: dataset with content of the batch
+        """
+        return cls(batch[b'data'], np.array(batch[b'labels']), path)
+
+    @classmethod
+    def from_files(cls, path: str = CIFAR_PATH,
+                   test: bool = False) -> 'CifarDataset':
+        """
+        :param path: path to folder with batch files
+        :param test: load the test batch instead of the data-batch files
+        :return: dataset with the whole train (or test) data
+        """
+        if test:
+            return cls(*read_test_batch(path), path=path)
+        return cls(*read_dataset(path), path=path)
+
+    def __len__(self) -> int:
+        return self.labels.shape[0]
+
+    def imgs_of_cat(self, category: int) -> np.ndarray:
+        """
+        :param category: Images of what category to obtain
+        :return: view of all images of the category (in their original
+                 order), read-only as it is shared by all calls
+        """
+        return self.sorted_imgs[self.offsets[category]:self.offsets[category + 1]]
+
+    def positions_of_cat(self, category: int) -> np.ndarray:
+        """
+        :param category: Positions of images of what category to obtain
+        :return: view of positions of the images in imgs (and labels)
+        """
+        return self.order[self.offsets[category]:self.offsets[category + 1]]
+
+    def label_name(self, label: int) -> str:
+        """
+        :param label: integer image label
+        :return: corresponding (decoded) string label name
+        """
+        return self.label_names[label]
@@ -0,0 +1,24 @@
+"""
+Modules of the project live flat in src/ and are imported by name,
+as the scripts and the notebook do.
+"""
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+sys.path.insert(0, os.path.abspath(SRC_DIR))
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """
+    Cached results of the test go to temporary directory.
+    """
+    import cache
+
+    path = tmp_path / 'cache'
+    path.mkdir()
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(path))
+    return path
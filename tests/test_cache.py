@@ -0,0 +1,122 @@
+import importlib
+import sys
+import textwrap
+
+import cache
+
+CALLER = '''
+def run(x):
+    from fp_helper import helper
+    return helper(x)
+'''
+
+
+def _write_modules(path, helper_body):
+    (path / 'fp_caller.py').write_text(textwrap.dedent(CALLER))
+    (path / 'fp_helper.py').write_text(
+        f"def helper(x):\n    return {helper_body}\n")
+
+
+def _fingerprint_of_caller():
+    for name in ('fp_caller', 'fp_helper'):
+        sys.modules.pop(name, None)
+    importlib.invalidate_caches()
+    return cache._fingerprint(importlib.import_module('fp_caller').run)
+
+
+def test_fingerprint_follows_local_imports(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'PROJECT_DIR', str(tmp_path))
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    _write_modules(tmp_path, "x + 1")
+    before = _fingerprint_of_caller()
+    assert _fingerprint_of_caller() == before
+
+    _write_modules(tmp_path, "x + 2")
+    after = _fingerprint_of_caller()
+    assert after != before
+
+    run = sys.modules['fp_caller'].run
+    assert cache._create_name(run, (1,), {}, before) != \
+        cache._create_name(run, (1,), {}, after)
+
+
+def test_fingerprint_of_preprocessing_covers_imported_transformers(monkeypatch):
+    import preprocessing
+
+    seen = []
+    qualified_name = cache._qualified_name
+
+    def record(obj):
+        seen.append(qualified_name(obj))
+        return seen[-1]
+
+    monkeypatch.setattr(cache, '_qualified_name', record)
+    cache._fingerprint(preprocessing.hog_preprocessing)
+    assert 'transformers.HogTransformer' in seen
+    assert 'transformers.CenteredPCA' in seen
+    assert 'features.batch_hog' in seen
+    assert 'reduction.fit_reducer' in seen
+
+
+def test_cached_function_recomputes_after_code_change(cache_dir):
+    calls = []
+
+    def compute(x):
+        calls.append(x)
+        return x * 2
+
+    cached = cache.cache(compute, verbose=False, memory_entries=0)
+    assert cached(3) == 6
+    assert cached(3) == 6
+    assert calls == [3]
+
+
+# Computations are logged outside of the arguments (existing files
+# given as arguments are keyed by their content)
+_LOG = {}
+
+
+def _slow_square(x):
+    import time
+    with open(_LOG['path'], 'a') as f:
+        f.write('computed\n')
+    time.sleep(0.3)
+    return x * x
+
+
+def _call_cached(cache_path, log_path, results):
+    cache.CACHE_DIR = cache_path
+    _LOG['path'] = log_path
+    cached = cache.cache(_slow_square, verbose=False, memory_entries=0)
+    results.put(cached(7))
+
+
+def test_concurrent_processes_compute_once(cache_dir, tmp_path):
+    import multiprocessing
+
+    log_path = str(tmp_path / 'log')
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [context.Process(target=_call_cached,
+                                 args=(str(cache_dir), log_path, results))
+                 for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+    assert [results.get(timeout=5) for _ in processes] == [49] * 3
+    with open(log_path) as f:
+        assert f.read().splitlines() == ['computed']
+
+
+def test_concurrent_threads_compute_once(cache_dir, tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    monkeypatch.setitem(_LOG, 'path', str(tmp_path / 'log'))
+    cached = cache.cache(_slow_square, verbose=False)
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda _: cached(5), range(4)))
+    assert results == [25] * 4
+    with open(_LOG['path']) as f:
+        assert f.read().splitlines() == ['computed']
@@ -0,0 +1,81 @@
+import json
+import os
+
+import numpy as np
+
+import feature_store
+import precision
+from transformers import HueTransformer
+
+
+def _images(n=120):
+    return np.random.RandomState(0).randint(0, 256, (n, 3072)).astype(np.uint8)
+
+
+def test_round_trip(tmp_path):
+    images = _images()
+    features = feature_store.materialize('hue', HueTransformer(), images, 'train',
+                                         chunk_size=50, root=str(tmp_path))
+    expected = HueTransformer().transform(images)
+    np.testing.assert_allclose(features.read(), expected)
+    assert features.read().dtype == precision.float_dtype()
+    assert len(features.meta['blocks']) == 1
+
+    # Stored rows are not extracted again
+    blocks = features.meta['blocks']
+    again = feature_store.materialize('hue', HueTransformer(), images, 'train',
+                                      root=str(tmp_path))
+    assert again.meta['blocks'] == blocks
+    np.testing.assert_allclose(
+        feature_store.load_features('hue', images, 'train', root=str(tmp_path)), expected)
+
+
+def test_interrupted_extraction_continues(tmp_path):
+    images = _images()
+    features = feature_store.materialize('hue', HueTransformer(), images[:40], 'train',
+                                         root=str(tmp_path))
+    assert len(features) == 40
+    # The same images are keyed by content hash, extend the stored set by hand
+    partial = feature_store.feature_set(features.meta['extractor'], features.meta['params'],
+                                        feature_store.cache.content_hash(images), 'train',
+                                        features.meta['code'], str(tmp_path))
+    partial.append(HueTransformer().transform(images[10:30]), np.arange(10, 30))
+
+    assert len(partial) == 20
+
+    done = feature_store.materialize('hue', HueTransformer(), images, 'train',
+                                     root=str(tmp_path))
+    assert done.path == partial.path
+    assert len(done) == len(images)
+    np.testing.assert_allclose(done.take(np.arange(len(images))),
+                               HueTransformer().transform(images))
+
+
+def test_precision_and_version_are_part_of_key(tmp_path, monkeypatch):
+    images = _images(30)
+    single = feature_store.materialize('hue', HueTransformer(), images, 'test',
+                                       root=str(tmp_path))
+    with precision.use_precision(np.float64):
+        double = feature_store.materialize('hue', HueTransformer(), images, 'test',
+                                           root=str(tmp_path))
+    assert single.path != double.path
+    assert single.read().dtype == np.float32
+    assert double.read().dtype == np.float64
+
+    monkeypatch.setattr(feature_store, 'STORE_VERSION', feature_store.STORE_VERSION + 1)
+    newer = feature_store.materialize('hue', HueTransformer(), images, 'test',
+                                      root=str(tmp_path))
+    assert newer.path != single.path
+
+
+def test_sets_without_dtype_are_float32(tmp_path):
+    images = _images(30)
+    features = feature_store.materialize('hue', HueTransformer(), images, 'test',
+                                         root=str(tmp_path))
+    meta_path = os.path.join(features.path, feature_store.META_NAME)
+    with open(meta_path) as f:
+        meta = json.load(f)
+    del meta['dtype']
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    assert feature_store.FeatureSet(features.path, {}).dtype == np.float32
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from skimage.color import rgb2hsv
+from skimage.feature import hog
+
+import features
+
+HOG_PARAMS = [
+    dict(orientations=9, pixels_per_cell=(8, 8), cells_per_block=(3, 3), block_norm='L2-Hys'),
+    dict(orientations=8, pixels_per_cell=(2, 2), cells_per_block=(2, 2), block_norm='L2-Hys'),
+    dict(orientations=6, pixels_per_cell=(4, 3), cells_per_block=(1, 2), block_norm='L1'),
+    dict(orientations=9, pixels_per_cell=(5, 5), cells_per_block=(2, 2), block_norm='L2'),
+]
+
+
+def _skimage_rgb_hog(img, **params):
+    try:
+        return hog(img, channel_axis=-1, **params)
+    except TypeError:
+        # scikit-image < 0.19
+        return hog(img, multichannel=True, **params)
+
+
+def _rgb_images(n=6):
+    return np.random.RandomState(0).rand(n, 32, 32, 3)
+
+
+@pytest.mark.parametrize('params', HOG_PARAMS)
+def test_batch_hog_matches_skimage_gray(params):
+    images = _rgb_images()[..., 0]
+    expected = np.array([hog(img, **params) for img in images])
+    out = features.batch_hog(images, dtype=np.float64, chunk_size=4, **params)
+    np.testing.assert_allclose(out, expected, rtol=1e-6, atol=1e-7)
+
+
+@pytest.mark.parametrize('params', HOG_PARAMS[:2])
+def test_batch_hog_matches_skimage_rgb(params):
+    images = _rgb_images()
+    expected = np.array([_skimage_rgb_hog(img, **params) for img in images])
+    out = features.batch_hog(images, multichannel=True, dtype=np.float64, **params)
+    np.testing.assert_allclose(out, expected, rtol=1e-6, atol=1e-7)
+
+
+@pytest.mark.parametrize('params', HOG_PARAMS)
+def test_batch_hog_of_no_images_has_feature_width(params):
+    images = _rgb_images()[..., 0]
+    width = features.batch_hog(images[:1], **params).shape[1]
+    out = features.batch_hog(images[:0], dtype=np.float32, **params)
+    assert out.shape == (0, width)
+    assert out.dtype == np.float32
+
+
+def test_batch_rgb_to_hsv_matches_skimage():
+    images = _rgb_images()
+    # Grays and ties between channels take the special cases of hue
+    images[0, :4] = 0.5
+    images[1, :4, :, 1] = images[1, :4, :, 2]
+    images[2, :4, :, 0] = images[2, :4, :, 1]
+    expected = np.array([rgb2hsv(img) for img in images])
+    np.testing.assert_allclose(features.batch_rgb_to_hsv(images, dtype=np.float64),
+                               expected, atol=1e-12)
+    np.testing.assert_allclose(features.batch_hue(images, dtype=np.float64),
+                               expected[..., 0], atol=1e-12)
+
+
+def test_batch_hue_of_uint8_images():
+    images = (_rgb_images() * 255).astype(np.uint8)
+    expected = np.array([rgb2hsv(img)[..., 0] for img in images])
+    np.testing.assert_allclose(features.batch_hue(images, dtype=np.float64, chunk_size=4),
+                               expected, atol=1e-12)
@@ -0,0 +1,104 @@
+import io
+import json
+from hashlib import sha256
+
+import pytest
+
+import cache
+
+
+def _backend(monkeypatch, files, blobs, token=None):
+    """
+    HTTPBackend answering from given ref files and blobs (digest -> bytes).
+    """
+    backend = cache.HTTPBackend('http://cache.invalid', token=token)
+    ref = {'files': files}
+    if token is not None:
+        ref['signature'] = cache._sign_ref(token, 'entry', files)
+    requested = []
+
+    def request(method, path, data=None, headers=None):
+        requested.append(path)
+        if path == '/refs/entry':
+            return io.BytesIO(json.dumps(ref).encode('utf-8'))
+        return io.BytesIO(blobs[path[len('/blobs/'):]])
+
+    monkeypatch.setattr(backend, '_request', request)
+    return backend, requested
+
+
+def test_fetch_writes_verified_files(tmp_path, monkeypatch):
+    content = b'manifest'
+    digest = sha256(content).hexdigest()
+    backend, _ = _backend(monkeypatch, {'manifest.pkl': digest}, {digest: content},
+                          token='secret')
+    dest = tmp_path / 'entry'
+    assert backend.fetch('entry', str(dest))
+    assert sorted(p.name for p in dest.iterdir()) == ['manifest.pkl']
+    assert (dest / 'manifest.pkl').read_bytes() == content
+
+
+@pytest.mark.parametrize('filename', [
+    '../evil', '/tmp/evil', 'a/b', '.hidden', '', '..', 'x/../../evil',
+])
+def test_fetch_rejects_bad_filenames(tmp_path, monkeypatch, filename):
+    digest = sha256(b'x').hexdigest()
+    backend, requested = _backend(monkeypatch, {filename: digest}, {digest: b'x'})
+    dest = tmp_path / 'cache' / 'entry'
+    dest.parent.mkdir()
+    with pytest.raises(cache.CorruptEntryError):
+        backend.fetch('entry', str(dest))
+    assert requested == ['/refs/entry']
+    assert not dest.exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['cache']
+
+
+@pytest.mark.parametrize('digest', ['../refs/x', 'ABC', '0' * 63, None])
+def test_fetch_rejects_bad_digests(tmp_path, monkeypatch, digest):
+    backend, requested = _backend(monkeypatch, {'manifest.pkl': digest}, {})
+    with pytest.raises(cache.CorruptEntryError):
+        backend.fetch('entry', str(tmp_path / 'entry'))
+    assert requested == ['/refs/entry']
+
+
+def test_fetch_rejects_corrupt_blob(tmp_path, monkeypatch):
+    digest = sha256(b'expected').hexdigest()
+    backend, _ = _backend(monkeypatch, {'manifest.pkl': digest}, {digest: b'tampered'})
+    dest = tmp_path / 'entry'
+    with pytest.raises(cache.CorruptEntryError):
+        backend.fetch('entry', str(dest))
+    assert not dest.exists()
+
+
+def test_fetch_rejects_unsigned_ref_with_token(tmp_path, monkeypatch):
+    digest = sha256(b'x').hexdigest()
+    backend, _ = _backend(monkeypatch, {'manifest.pkl': digest}, {digest: b'x'})
+    backend.token = 'secret'
+    with pytest.raises(cache.CorruptEntryError):
+        backend.fetch('entry', str(tmp_path / 'entry'))
+
+
+def test_store_and_fetch_through_server(tmp_path):
+    import threading
+    from cache_server import CacheServer
+
+    server = CacheServer(('127.0.0.1', 0), str(tmp_path / 'shared'), token='secret')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        backend = cache.HTTPBackend(f'http://127.0.0.1:{server.server_address[1]}',
+                                    token='secret')
+        entry = tmp_path / 'entry'
+        entry.mkdir()
+        (entry / 'manifest.pkl').write_bytes(b'manifest')
+        (entry / 'array-0.npy').write_bytes(b'array' * 1000)
+        backend.store('entry', str(entry))
+
+        dest = tmp_path / 'fetched'
+        assert backend.fetch('entry', str(dest))
+        assert {p.name: p.read_bytes() for p in dest.iterdir()} == \
+            {p.name: p.read_bytes() for p in entry.iterdir()}
+        assert not backend.fetch('missing', str(tmp_path / 'missing'))
+    finally:
+        server.shutdown()
+        server.server_close()
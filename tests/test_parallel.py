@@ -0,0 +1,28 @@
+import numpy as np
+
+import parallel
+from features import batch_hog
+
+PARAMS = dict(orientations=8, pixels_per_cell=(4, 4), cells_per_block=(2, 2))
+
+
+def _gray_images(n):
+    return np.random.RandomState(0).rand(n, 32, 32)
+
+
+def test_parallel_matches_serial_and_reuses_workers():
+    images = _gray_images(250)
+    expected = batch_hog(images, **PARAMS)
+
+    first = parallel.parallel_extract(batch_hog, images, n_jobs=2, chunk_size=60, **PARAMS)
+    executor = parallel._EXECUTOR['executor']
+    second = parallel.parallel_extract(batch_hog, images[:100], n_jobs=2, chunk_size=30,
+                                       **PARAMS)
+    np.testing.assert_allclose(first, expected)
+    np.testing.assert_allclose(second, expected[:100])
+    assert parallel._EXECUTOR['executor'] is executor
+
+
+def test_parallel_empty_input():
+    out = parallel.parallel_extract(batch_hog, _gray_images(0), n_jobs=2, **PARAMS)
+    assert out.shape == (0, batch_hog(_gray_images(1), **PARAMS).shape[1])
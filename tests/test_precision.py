@@ -0,0 +1,51 @@
+import threading
+
+import numpy as np
+import pytest
+
+import cache
+import precision
+from features import batch_hue
+
+
+def test_use_precision_restores_previous():
+    assert precision.float_dtype() == np.float32
+    with precision.use_precision(np.float64):
+        assert precision.float_dtype() == np.float64
+        assert batch_hue(np.zeros((1, 2, 2, 3), dtype=np.uint8)).dtype == np.float64
+    assert precision.float_dtype() == np.float32
+    assert precision.float_dtype(np.float64) == np.float64
+    with pytest.raises(ValueError):
+        precision.set_precision(np.float16)
+
+
+def test_precision_is_part_of_cache_key():
+    def f(x):
+        return x
+
+    single = cache._create_name(f, (1,), {})
+    with precision.use_precision(np.float64):
+        double = cache._create_name(f, (1,), {})
+    assert single != double
+
+
+_GATE = threading.Event()
+
+
+def _ones():
+    _GATE.wait(10)
+    return np.ones(3, dtype=precision.float_dtype())
+
+
+def test_prefetch_keeps_precision_of_submission(cache_dir):
+    cached = cache.cache(_ones, verbose=False)
+    _GATE.clear()
+    with precision.use_precision(np.float64):
+        future = cache.prefetch(cached)
+    # The block has ended before the computation runs
+    _GATE.set()
+    assert future.result().dtype == np.float64
+    assert precision.float_dtype() == np.float32
+    with precision.use_precision(np.float64):
+        assert cached().dtype == np.float64
+    assert cached().dtype == np.float32
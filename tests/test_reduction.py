@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+import cache
+import reduction
+from features import LazyFeatures
+from transformers import CenteredPCA
+
+N_TRAIN, N_TEST = 300, 40
+
+
+def _rows():
+    rng = np.random.RandomState(0)
+    basis = rng.randn(8, 30)
+    return rng.randn(N_TRAIN + N_TEST, 8).dot(basis) + 0.01 * rng.randn(N_TRAIN + N_TEST, 30)
+
+
+def _lazy(rows, counter):
+    def extract(x):
+        counter.append(len(x))
+        return x
+    # The extracted rows of LazyFeatures are the "images" themselves
+    features = LazyFeatures(rows, extract)
+    counter.clear()
+    return features
+
+
+@pytest.mark.parametrize('method, passes', [('full', 1), ('randomized', 1), ('incremental', 2)])
+def test_fit_transform_extracts_train_features_once(cache_dir, method, passes):
+    rows = _rows()
+    counter = []
+    train = _lazy(rows[:N_TRAIN], counter)
+    train_x, test_x, reducer = reduction.fit_transform(train, rows[N_TRAIN:], method, 0.9)
+    assert sum(counter) == passes * N_TRAIN
+    np.testing.assert_allclose(train_x, reducer.transform(rows[:N_TRAIN]), atol=1e-4)
+
+    # Fit again, not from the cache
+    cache.clear_cache()
+    pca = CenteredPCA(method, 0.9)
+    train = _lazy(rows[:N_TRAIN], counter)
+    reduced = pca.fit_transform(train)
+    assert sum(counter) == passes * N_TRAIN
+    np.testing.assert_allclose(reduced, pca.transform(rows[:N_TRAIN]), atol=1e-4)
+
+
+def test_incremental_grows_components_to_variance(cache_dir):
+    rows = np.random.RandomState(1).randn(400, 60)
+    with pytest.warns(UserWarning):
+        reducer = reduction.fit_reducer(rows, 'incremental', 0.95, n_components=5,
+                                        chunk_size=100)
+    assert reducer.variance_curve[-1] >= 0.95
+    assert reducer.with_variance(0.95).n_components_ <= len(reducer.components_)
@@ -0,0 +1,34 @@
+import pickle
+
+import numpy as np
+import pytest
+
+import utils
+
+LABEL_NAMES = [f'cat{i}'.encode() for i in range(10)]
+
+
+@pytest.fixture
+def dataset_path(tmp_path):
+    with open(tmp_path / 'batches.meta', 'wb') as f:
+        pickle.dump({b'label_names': LABEL_NAMES}, f)
+    return str(tmp_path)
+
+
+def test_imgs_of_cat_are_views_in_original_order(dataset_path):
+    rng = np.random.RandomState(0)
+    labels = rng.randint(0, 10, 200)
+    imgs = rng.randint(0, 256, (200, 3072)).astype(np.uint8)
+    dataset = utils.CifarDataset(imgs, labels, dataset_path)
+
+    for category in range(10):
+        expected = imgs[labels == category]
+        first = dataset.imgs_of_cat(category)
+        np.testing.assert_array_equal(first, expected)
+        # The same memory every time, not a new copy
+        assert np.shares_memory(first, dataset.imgs_of_cat(category))
+        assert not first.flags.writeable
+        np.testing.assert_array_equal(imgs[dataset.positions_of_cat(category)], expected)
+    assert dataset.imgs is imgs
+    assert list(dataset.counts) == [np.count_nonzero(labels == c) for c in range(10)]
+    assert dataset.label_name(3) == 'cat3'